@@ -0,0 +1,163 @@
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+
+class OverloadedError(Exception):
+    """Raised when a stage is at capacity and its wait queue is full"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+def estimate_retry_after(waiting, average_seconds, slots):
+    """Seconds until the work ahead of a new request (queued plus running) should have drained"""
+    return max(1, (waiting + 1) * average_seconds / max(1, slots))
+
+
+class StageLimiter:
+    """
+    Bounded concurrency for one pipeline stage. Up to `limit` callers run at once,
+    up to `max_waiting` more wait for a slot, and anything beyond is rejected with
+    an OverloadedError carrying a Retry-After estimate based on recent service times.
+    """
+
+    def __init__(self, name, limit, max_waiting, expected_seconds, max_wait_seconds=None):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_waiting = max(0, max_waiting)
+        self.average_seconds = float(expected_seconds)
+        self.max_wait_seconds = max_wait_seconds
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+        metrics.STAGE_ACTIVE.set(0, stage=name)
+
+    def retry_after(self):
+        return estimate_retry_after(self.waiting, self.average_seconds, self.limit)
+
+    def acquire(self):
+        with self.condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.max_waiting:
+                    metrics.STAGE_REJECTIONS.inc(stage=self.name)
+                    raise OverloadedError(f"Server is busy ({self.name} at capacity). Please try again later.", self.retry_after())
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + self.max_wait_seconds if self.max_wait_seconds else None
+                    while self.active >= self.limit:
+                        remaining = deadline - time.monotonic() if deadline else None
+                        if remaining is not None and remaining <= 0:
+                            metrics.STAGE_REJECTIONS.inc(stage=self.name)
+                            raise OverloadedError(f"Server is busy ({self.name} queue timed out). Please try again later.", self.retry_after())
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            metrics.STAGE_ACTIVE.set(self.active, stage=self.name)
+
+    def release(self, elapsed=None):
+        with self.condition:
+            self.active -= 1
+            if elapsed is not None:
+                # Exponentially weighted average keeps Retry-After tracking current load
+                self.average_seconds = 0.8 * self.average_seconds + 0.2 * elapsed
+            metrics.STAGE_ACTIVE.set(self.active, stage=self.name)
+            self.condition.notify()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+
+class PriorityStageLimiter(StageLimiter):
+    """
+    StageLimiter whose waiting callers are admitted lowest `priority` first instead of
+    in arrival order, e.g. short clips ahead of long videos. Equal priorities stay FIFO.
+    """
+
+    def __init__(self, name, limit, max_waiting, expected_seconds, max_wait_seconds=None):
+        super().__init__(name, limit, max_waiting, expected_seconds, max_wait_seconds)
+        self.queue = []  # heap of (priority, sequence)
+        self.sequence = itertools.count()
+
+    def acquire(self, priority=0):
+        with self.condition:
+            if self.active >= self.limit or self.queue:
+                if self.waiting >= self.max_waiting:
+                    metrics.STAGE_REJECTIONS.inc(stage=self.name)
+                    raise OverloadedError(f"Server is busy ({self.name} at capacity). Please try again later.", self.retry_after())
+                entry = (priority, next(self.sequence))
+                heapq.heappush(self.queue, entry)
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + self.max_wait_seconds if self.max_wait_seconds else None
+                    while self.active >= self.limit or self.queue[0] != entry:
+                        remaining = deadline - time.monotonic() if deadline else None
+                        if remaining is not None and remaining <= 0:
+                            self.queue.remove(entry)
+                            heapq.heapify(self.queue)
+                            self.condition.notify_all()  # The head of the queue may have changed
+                            metrics.STAGE_REJECTIONS.inc(stage=self.name)
+                            raise OverloadedError(f"Server is busy ({self.name} queue timed out). Please try again later.", self.retry_after())
+                        self.condition.wait(remaining)
+                    heapq.heappop(self.queue)
+                finally:
+                    self.waiting -= 1
+                # Another slot may still be free for the next caller in line
+                self.condition.notify_all()
+            self.active += 1
+            metrics.STAGE_ACTIVE.set(self.active, stage=self.name)
+
+    def release(self, elapsed=None):
+        with self.condition:
+            super().release(elapsed)
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority=0):
+        self.acquire(priority)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+
+# Per-stage limits (override through environment variables)
+BROWSER_LIMITER = StageLimiter(
+    'browser',
+    int(os.getenv('AUDIO_MAX_BROWSERS', '2')),
+    int(os.getenv('AUDIO_MAX_BROWSER_QUEUE', '8')),
+    expected_seconds=30,
+    max_wait_seconds=int(os.getenv('AUDIO_MAX_STAGE_WAIT', '120'))
+)
+DOWNLOAD_LIMITER = StageLimiter(
+    'download',
+    int(os.getenv('AUDIO_MAX_DOWNLOADS', '4')),
+    int(os.getenv('AUDIO_MAX_DOWNLOAD_QUEUE', '16')),
+    expected_seconds=20,
+    max_wait_seconds=int(os.getenv('AUDIO_MAX_STAGE_WAIT', '120'))
+)
+CPU_COUNT = os.cpu_count() or 2
+# Concurrent FFmpeg processes, each given an equal share of the cores through -threads
+FFMPEG_LIMITER = PriorityStageLimiter(
+    'ffmpeg',
+    int(os.getenv('AUDIO_MAX_FFMPEG', str(max(1, CPU_COUNT // 2)))),
+    int(os.getenv('AUDIO_MAX_FFMPEG_QUEUE', '16')),
+    expected_seconds=15,
+    max_wait_seconds=int(os.getenv('AUDIO_MAX_STAGE_WAIT', '120'))
+)
+FFMPEG_THREADS = int(os.getenv('AUDIO_FFMPEG_THREADS', str(max(1, CPU_COUNT // FFMPEG_LIMITER.limit))))
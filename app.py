@@ -1,8 +1,16 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
+import json
 import os
+import re
 import sys
 import tempfile
-from audio import main as process_audio
+from audio import main as process_audio, stream_audio, resolve_download_urls, AUDIO_FORMAT, AUDIO_BITRATE, OUTPUT_FORMATS
+from audio_cache import AudioCache, cache_key
+import metrics
+import browser_pool
+from admission import OverloadedError
+from jobs import JobManager, STATUS_COMPLETED
+from batch import stream_batch_zip, BATCH_MAX_URLS, BATCH_DEFAULT_PARALLELISM, BATCH_MAX_PARALLELISM
 from flask_cors import CORS
 import logging
 
@@ -28,22 +36,172 @@ CORS(app)
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 app.logger.setLevel(logging.INFO)
 
+# Finished MP3s are cached on disk by canonical video ID, format and bitrate
+audio_cache = AudioCache()
+# Background worker pool that runs the SnapSave + FFmpeg pipeline
+job_manager = JobManager(process_audio, cache=audio_cache, handoff=True)
+
+# How long the synchronous endpoint waits for its job before giving up
+SYNC_JOB_TIMEOUT = int(os.getenv('AUDIO_SYNC_TIMEOUT', '300'))
+# Cache lifetime advertised for artifacts (they never change under the same ID and ETag)
+ARTIFACT_MAX_AGE = int(os.getenv('AUDIO_ARTIFACT_MAX_AGE', '86400'))
+# Most output profiles one job may produce from a single decode
+MAX_OUTPUT_PROFILES = int(os.getenv('AUDIO_MAX_OUTPUT_PROFILES', '4'))
+
+def parse_output_profile(data):
+    """Read the requested output format and bitrate, raising ValueError on bad input"""
+    audio_format = str(data.get('format') or AUDIO_FORMAT).lower()
+    bitrate = str(data.get('bitrate') or AUDIO_BITRATE).lower()
+    if audio_format not in OUTPUT_FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(OUTPUT_FORMATS)}")
+    if not re.match(r'^\d{2,3}k$', bitrate):
+        raise ValueError("bitrate must look like '192k'")
+    return audio_format, bitrate
+
+def parse_batch(data):
+    """Read the `videoUrls` list and `parallelism` of a batch request, raising ValueError on bad input"""
+    video_urls = data.get('videoUrls')
+    if not isinstance(video_urls, list) or not video_urls:
+        raise ValueError('videoUrls must be a non-empty list')
+    if len(video_urls) > BATCH_MAX_URLS:
+        raise ValueError(f'At most {BATCH_MAX_URLS} URLs per batch')
+    if not all(isinstance(url, str) and url for url in video_urls):
+        raise ValueError('Every video URL must be a non-empty string')
+    try:
+        parallelism = int(data.get('parallelism', BATCH_DEFAULT_PARALLELISM))
+    except (TypeError, ValueError):
+        raise ValueError('parallelism must be an integer')
+    return video_urls, max(1, min(parallelism, BATCH_MAX_PARALLELISM))
+
+def parse_timestamp(value, name):
+    """Seconds from a number or an 'SS', 'MM:SS' or 'HH:MM:SS' string"""
+    try:
+        if isinstance(value, str):
+            seconds = 0.0
+            for part in value.strip().split(':'):
+                seconds = seconds * 60 + float(part)
+        else:
+            seconds = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be seconds or HH:MM:SS")
+    if seconds < 0 or seconds != seconds or seconds == float('inf'):
+        raise ValueError(f"{name} must be a non-negative time")
+    return round(seconds, 3)
+
+def parse_clip(data):
+    """Read optional `start`/`end` times. Returns (start, end) with end None for 'until the end', or None."""
+    if data.get('start') in (None, '') and data.get('end') in (None, ''):
+        return None
+    start = parse_timestamp(data['start'], 'start') if data.get('start') not in (None, '') else 0.0
+    end = parse_timestamp(data['end'], 'end') if data.get('end') not in (None, '') else None
+    if end is not None and end <= start:
+        raise ValueError("end must be after start")
+    return start, end
+
+def job_options(audio_format, bitrate, clip):
+    options = {'audio_format': audio_format, 'bitrate': bitrate}
+    if clip:
+        options['clip'] = clip
+    return options
+
+def parse_output_profiles(data):
+    """
+    Read a `profiles` list of {format, bitrate} objects for a multi-output job.
+    Returns None when the request doesn't use it; duplicates are dropped.
+    """
+    profiles = data.get('profiles')
+    if profiles is None:
+        return None
+    if not isinstance(profiles, list) or not profiles or not all(isinstance(profile, dict) for profile in profiles):
+        raise ValueError("profiles must be a non-empty list of {format, bitrate} objects")
+    parsed = []
+    for profile in profiles:
+        output_profile = parse_output_profile(profile)
+        if output_profile not in parsed:
+            parsed.append(output_profile)
+    if len(parsed) > MAX_OUTPUT_PROFILES:
+        raise ValueError(f"At most {MAX_OUTPUT_PROFILES} profiles are allowed per job")
+    return parsed
+
+def artifact_links(artifact_id):
+    """Link header value pointing at the other outputs produced with an artifact"""
+    return ', '.join(
+        f'</artifacts/{member["artifactId"]}>; rel="alternate"; type="{OUTPUT_FORMATS[member["format"]]["mimetype"]}"; bitrate="{member["bitrate"]}"'
+        for member in audio_cache.related(artifact_id) if member.get('format') in OUTPUT_FORMATS
+    )
+
+def send_audio(audio_file_path):
+    """
+    Send an audio file. Cached artifacts are served with Range, ETag and
+    If-None-Match support so clients can resume and CDNs can cache them.
+    """
+    artifact_id = audio_cache.artifact_id(audio_file_path)
+    audio_format = os.path.splitext(audio_file_path)[1].lstrip('.').lower()
+    if audio_format not in OUTPUT_FORMATS:
+        audio_format = AUDIO_FORMAT
+    response = send_file(
+        audio_file_path, 
+        as_attachment=True, 
+        download_name=f'freefbzone_audio.{audio_format}',
+        mimetype=OUTPUT_FORMATS[audio_format]['mimetype'],
+        conditional=True,
+        etag=True,
+        max_age=ARTIFACT_MAX_AGE if artifact_id else None
+    )
+    if artifact_id:
+        response.headers['X-Artifact-Id'] = artifact_id
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.cache_control.public = True
+        links = artifact_links(artifact_id)
+        if links:
+            response.headers['Link'] = links
+    return response
+
+def overloaded_response(message, retry_after):
+    """429 response telling the client when the pipeline should have room again"""
+    response = jsonify({'error': message, 'retryAfter': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.errorhandler(OverloadedError)
+def handle_overloaded(e):
+    return overloaded_response(str(e), e.retry_after)
+
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({
         'status': 'FreeFBZone Audio Processing Server is running!',
         'endpoints': {
             'POST /download-audio': 'Download audio from Facebook video',
-            'GET /health': 'Health check'
+            'POST /download-audio/batch': 'Download audio from many videos as a streamed ZIP',
+            'POST /resolve/batch': 'Resolve direct video URLs for many videos, streamed as NDJSON',
+            'POST /stream-audio': 'Stream audio while the video downloads (no temp files)',
+            'POST /jobs': 'Submit an audio job, returns a job id',
+            'GET /jobs/<id>': 'Job status, stage and progress',
+            'GET /jobs/<id>/result': 'Download the finished audio file',
+            'GET /artifacts/<id>': 'Download a finished audio file by artifact id (supports Range and ETag)',
+            'GET /health': 'Health check',
+            'GET /metrics': 'Prometheus metrics'
         }
     })
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'healthy', 'service': 'audio-processing'})
+    return jsonify({
+        'status': 'healthy',
+        'service': 'audio-processing',
+        'jobs': job_manager.stats(),
+        'browsers': browser_pool.pool_stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/download-audio', methods=['POST'])
 def download_audio():
+    """Synchronous wrapper around the job queue, kept for existing clients"""
     try:
         data = request.get_json()
         video_url = data.get('videoUrl')
@@ -51,28 +209,236 @@ def download_audio():
         if not video_url:
             return jsonify({'error': 'Video URL is required'}), 400
         
+        try:
+            audio_format, bitrate = parse_output_profile(data)
+            clip = parse_clip(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         print(f"Processing audio download for: {video_url}")
         
-        # Process the video and get audio file
-        audio_file_path = process_audio(video_url)
+        key = cache_key(video_url, audio_format, bitrate, clip)
+        cached_path = audio_cache.get(key)
+        if cached_path:
+            print(f"Serving cached audio: {key}")
+            metrics.CACHE_REQUESTS.inc(result='hit')
+            return send_audio(cached_path)
         
-        if not audio_file_path or not os.path.exists(audio_file_path):
-            return jsonify({'error': 'Failed to process audio'}), 500
+        job = job_manager.submit(video_url, key, job_options(audio_format, bitrate, clip))
+        if not job.wait(SYNC_JOB_TIMEOUT):
+            return jsonify({'error': 'Audio processing timed out', 'jobId': job.id}), 504
         
-        print(f"Audio file ready: {audio_file_path}")
+        if job.status != STATUS_COMPLETED:
+            if job.retry_after:
+                return overloaded_response(job.error, job.retry_after)
+            return jsonify({'error': job.error or 'Failed to process audio'}), 500
+        
+        print(f"Audio file ready: {job.result_path}")
         
         # Send the audio file to user
-        return send_file(
-            audio_file_path, 
-            as_attachment=True, 
-            download_name='freefbzone_audio.mp3',
-            mimetype='audio/mpeg'
-        )
+        return send_audio(job.result_path)
         
+    except OverloadedError as e:
+        return overloaded_response(str(e), e.retry_after)
     except Exception as e:
         print(f"Error in download_audio: {str(e)[:200]}...")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/download-audio/batch', methods=['POST'])
+def download_audio_batch():
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        video_urls, parallelism = parse_batch(data)
+        audio_format, bitrate = parse_output_profile(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    print(f"Processing audio batch of {len(video_urls)} videos (parallelism {parallelism})")
+    archive = stream_batch_zip(
+        job_manager,
+        video_urls,
+        key_for=lambda url: cache_key(url, audio_format, bitrate),
+        parallelism=parallelism,
+        audio_format=audio_format,
+        options={'audio_format': audio_format, 'bitrate': bitrate}
+    )
+    return Response(
+        archive,
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=freefbzone_audio_batch.zip'}
+    )
+
+def option_fields(option):
+    """One row of SnapSave's download table as returned to clients"""
+    return {
+        'quality': option.get('quality'),
+        'resolution': option.get('resolution'),
+        'url': option.get('url'),
+        'size': option.get('size'),
+        'audioOnly': option.get('audio_only'),
+        'hasAudio': option.get('has_audio')
+    }
+
+@app.route('/resolve/batch', methods=['POST'])
+def resolve_batch_endpoint():
+    """
+    Resolve the direct download URL of many videos concurrently. One JSON line is
+    streamed per URL as soon as it is resolved; a failed URL gets its own error line.
+    """
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        video_urls, parallelism = parse_batch(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    prefer = data.get('prefer', 'video')
+    if prefer not in ('video', 'audio'):
+        return jsonify({'error': "prefer must be 'video' or 'audio'"}), 400
+    
+    def generate():
+        for index, video_url, result in resolve_download_urls(video_urls, prefer, parallelism):
+            line = {'index': index, 'videoUrl': video_url, 'success': result['success']}
+            if result['success']:
+                line.update(downloadUrl=result['download_url'], quality=result.get('quality'), method=result.get('method'))
+                if result.get('options'):
+                    line['options'] = [option_fields(option) for option in result['options']]
+            else:
+                line['error'] = result['error']
+            yield json.dumps(line) + '\n'
+    
+    print(f"Resolving batch of {len(video_urls)} videos (parallelism {parallelism})")
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/stream-audio', methods=['POST'])
+def stream_audio_endpoint():
+    """
+    Stream audio bytes to the client while the video is still downloading.
+    Falls back to the regular job pipeline if the source can't be decoded from a pipe.
+    """
+    data = request.get_json(silent=True) or {}
+    video_url = data.get('videoUrl')
+    
+    if not video_url:
+        return jsonify({'error': 'Video URL is required'}), 400
+    
+    try:
+        audio_format, bitrate = parse_output_profile(data)
+        clip = parse_clip(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if clip:
+        # Clips seek inside the CDN file, which a pipe can't do; the job pipeline handles them
+        return download_audio()
+    
+    key = cache_key(video_url, audio_format, bitrate)
+    cached_path = audio_cache.get(key)
+    if cached_path:
+        metrics.CACHE_REQUESTS.inc(result='hit')
+        return send_audio(cached_path)
+    
+    try:
+        audio_stream = stream_audio(video_url, audio_format, bitrate)
+    except OverloadedError:
+        raise
+    except Exception as e:
+        print(f"[STREAM] Streaming unavailable, falling back to job pipeline: {str(e)[:200]}")
+        metrics.FALLBACKS.inc(source='stream', target='job')
+        return download_audio()
+    
+    return Response(
+        audio_stream,
+        mimetype=OUTPUT_FORMATS[audio_format]['mimetype'],
+        headers={'Content-Disposition': f'attachment; filename=freefbzone_audio.{audio_format}'}
+    )
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    data = request.get_json(silent=True) or {}
+    video_url = data.get('videoUrl')
+    
+    if not video_url:
+        return jsonify({'error': 'Video URL is required'}), 400
+    
+    try:
+        profiles = parse_output_profiles(data)
+        audio_format, bitrate = profiles[0] if profiles else parse_output_profile(data)
+        clip = parse_clip(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if profiles and len(profiles) > 1:
+        # All profiles come out of one download and one FFmpeg decode
+        options = {'profiles': profiles}
+        if clip:
+            options['clip'] = clip
+        job = job_manager.submit(
+            video_url,
+            tuple(cache_key(video_url, *profile, clip) for profile in profiles),
+            options
+        )
+    else:
+        job = job_manager.submit(
+            video_url,
+            cache_key(video_url, audio_format, bitrate, clip),
+            job_options(audio_format, bitrate, clip)
+        )
+    return jsonify({'jobId': job.id, 'status': job.status}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    status = job.to_dict()
+    artifact_id = audio_cache.artifact_id(job.result_path) if job.status == STATUS_COMPLETED else None
+    if artifact_id:
+        status['artifactId'] = artifact_id
+        status['artifactUrl'] = f"/artifacts/{artifact_id}"
+    profiles = job.options.get('profiles')
+    if profiles and job.status == STATUS_COMPLETED:
+        status['artifacts'] = []
+        for (audio_format, bitrate), path in zip(profiles, job.result_paths):
+            output = {'format': audio_format, 'bitrate': bitrate}
+            output_artifact_id = audio_cache.artifact_id(path)
+            if output_artifact_id:
+                output['artifactId'] = output_artifact_id
+                output['artifactUrl'] = f"/artifacts/{output_artifact_id}"
+            status['artifacts'].append(output)
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job.status != STATUS_COMPLETED:
+        if job.retry_after:
+            return overloaded_response(job.error, job.retry_after)
+        if job.error:
+            return jsonify({'error': job.error, 'status': job.status}), 500
+        return jsonify({'error': 'Job is not finished yet', 'status': job.status}), 409
+    
+    # Multi-output jobs pick an output by its index in `profiles` (default: the first)
+    output = request.args.get('output', '0')
+    if not output.isdigit() or int(output) >= len(job.result_paths):
+        return jsonify({'error': 'Unknown output'}), 404
+    result_path = job.result_paths[int(output)]
+    if not result_path or not os.path.exists(result_path):
+        return jsonify({'error': 'Audio file is no longer available'}), 410
+    
+    return send_audio(result_path)
+
+@app.route('/artifacts/<artifact_id>', methods=['GET'])
+def get_artifact(artifact_id):
+    artifact_path = audio_cache.artifact_path(artifact_id)
+    if not artifact_path:
+        return jsonify({'error': 'Artifact not found'}), 404
+    return send_audio(artifact_path)
+
 if __name__ == '__main__':
     print("Starting Flask Audio Processing Server on port 5000...")
     # Use 0.0.0.0 to bind to all interfaces in Docker, 127.0.0.1 for local development
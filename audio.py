@@ -1,8 +1,16 @@
 import requests
 import os
-import tempfile
 import sys
+import time
 from pathlib import Path
+import metrics
+import event_loop
+import remote_convert
+import url_cache
+from downloader import download_file, PartialDownload, UrlExpiredError, EXPIRED_STATUSES
+from admission import OverloadedError, BROWSER_LIMITER, DOWNLOAD_LIMITER, FFMPEG_LIMITER, FFMPEG_THREADS
+from scratch import get_scratch_manager
+from audio_cache import profile_key, format_seconds
 
 # Fix Windows console encoding issues
 if sys.platform == "win32":
@@ -18,91 +26,295 @@ if sys.platform == "win32":
     except:
         pass  # If encoding setup fails, continue with default encoding
 
-# Function to download video using Snapsave
-def download_from_snapsave(video_url):
-    """Wrapper function that calls the async snapsave downloader and saves the file locally"""
-    import asyncio
-    from snapsave_downloader import download_facebook_video_snapsave
+# Default output profile produced by the local FFmpeg conversion
+AUDIO_FORMAT = 'mp3'
+AUDIO_BITRATE = '192k'
+# Times a download may re-resolve its signed CDN URL through SnapSave after it expires
+URL_REFRESHES = int(os.getenv('AUDIO_DOWNLOAD_URL_REFRESHES', '2'))
+# FFmpeg queue priority for files whose duration can't be probed (sorted after clips up to an hour)
+UNKNOWN_DURATION_PRIORITY = 3600
+
+# Supported output formats. Sources whose audio codec is in `copy_codecs`
+# are remuxed with stream copy instead of being re-encoded.
+OUTPUT_FORMATS = {
+    'mp3': {'mimetype': 'audio/mpeg', 'encoder': 'libmp3lame', 'muxer': 'mp3', 'copy_codecs': ('mp3',)},
+    'm4a': {'mimetype': 'audio/mp4', 'encoder': 'aac', 'muxer': 'ipod', 'copy_codecs': ('aac',)},
+    'opus': {'mimetype': 'audio/ogg', 'encoder': 'libopus', 'muxer': 'opus', 'copy_codecs': ('opus',)},
+}
+
+def probe_media(video_file_path):
+    """
+    Return (audio_codec, duration_seconds) for a media file in one ffprobe call,
+    with None for anything that can't be probed
+    """
+    import json
+    import subprocess
+    
+    try:
+        result = subprocess.run([
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'a:0',
+            '-show_entries', 'stream=codec_name:format=duration',
+            '-of', 'json',
+            video_file_path
+        ], capture_output=True, text=True, timeout=30)
+        info = json.loads(result.stdout or '{}') if result.returncode == 0 else {}
+    except (FileNotFoundError, subprocess.TimeoutExpired, ValueError):
+        return None, None
+    streams = info.get('streams') or [{}]
+    try:
+        duration = float(info.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+    return streams[0].get('codec_name'), duration
+
+def ffmpeg_audio_args(audio_format, bitrate, source_codec=None):
+    """FFmpeg output arguments for a format: stream copy when the source codec allows it, else an encode"""
+    output_format = OUTPUT_FORMATS[audio_format]
+    if source_codec and source_codec in output_format['copy_codecs']:
+        return ['-c:a', 'copy']
+    args = ['-c:a', output_format['encoder'], '-b:a', bitrate]
+    if audio_format == 'mp3':
+        args += ['-ar', '44100']  # Audio sample rate
+    return args
+
+# Function to resolve the direct CDN download URL using Snapsave
+def resolve_download_url(video_url, prefer='audio', refresh=False):
+    """
+    Resolve the direct video URL through SnapSave: a plain HTTP lookup first, the
+    browser automation if that fails. URLs resolved earlier (by any process) are reused
+    until shortly before their signature expires; `refresh` forces a new lookup.
+    Audio jobs ask for the smallest usable rendition to cut download size.
+    """
+    from snapsave_downloader import download_facebook_video_snapsave, resolve_via_http, HTTP_FAST_PATH
+    
+    if refresh:
+        url_cache.invalidate(video_url)
+    else:
+        cached_url = url_cache.get(video_url, prefer)
+        if cached_url:
+            return cached_url
+    
+    # The plain HTTP lookup needs no browser, so it runs outside the browser limit
+    if HTTP_FAST_PATH:
+        start = time.perf_counter()
+        try:
+            result = resolve_via_http(video_url, prefer=prefer)
+            metrics.SNAPSAVE_RESOLVE_SECONDS.observe(time.perf_counter() - start, outcome='success', method='http')
+            url_cache.put(video_url, prefer, result['download_url'])
+            return result['download_url']
+        except Exception as e:
+            metrics.SNAPSAVE_RESOLVE_SECONDS.observe(time.perf_counter() - start, outcome='failure', method='http')
+            metrics.FALLBACKS.inc(source='snapsave_http', target='browser')
+            print(f"[FALLBACK] HTTP lookup failed, using the browser: {str(e)[:150]}")
+    
+    from browser_pool import get_browser_pool
     
+    # Run the async function on the shared loop with the warm browser pool (browser sessions are limited, see admission.py)
+    with BROWSER_LIMITER.slot():
+        start = time.perf_counter()
+        pool = get_browser_pool()
+        result = event_loop.run(download_facebook_video_snapsave(video_url, prefer=prefer, pool=pool, fast_path=False))
+    
+    outcome = 'success' if result['success'] else 'failure'
+    metrics.SNAPSAVE_RESOLVE_SECONDS.observe(time.perf_counter() - start, outcome=outcome, method='browser')
+    
+    if not result['success']:
+        raise Exception(f"SnapSave failed: {result['error']}")
+    
+    url_cache.put(video_url, prefer, result['download_url'])
+    return result['download_url']
+
+def resolve_download_urls(video_urls, prefer='audio', parallelism=None):
+    """
+    Resolve many videos concurrently and yield (index, video_url, result) as each one finishes.
+    Cached URLs come back first; the rest run as one batch on the browser pool, one tab
+    per lookup. The batch never holds more contexts than the pool has, and waits for
+    them are bounded by the pool, so interactive jobs still get a 429 instead of hanging.
+    """
+    from snapsave_downloader import resolve_batch, BATCH_RESOLVE_PARALLELISM
+    from browser_pool import get_browser_pool
+    
+    misses = []
+    for index, video_url in enumerate(video_urls):
+        cached_url = url_cache.get(video_url, prefer)
+        if cached_url:
+            yield index, video_url, {'success': True, 'download_url': cached_url, 'method': 'cache'}
+        else:
+            misses.append((index, video_url))
+    if not misses:
+        return
+    
+    pool = get_browser_pool()
+    batch = resolve_batch([video_url for _, video_url in misses], prefer, pool, parallelism or BATCH_RESOLVE_PARALLELISM)
+    for position, video_url, result in event_loop.iterate(batch):
+        if result['success']:
+            url_cache.put(video_url, prefer, result['download_url'])
+        yield misses[position][0], video_url, result
+
+# Function to download video using Snapsave
+def download_from_snapsave(video_url, workspace, download_url=None):
+    """
+    Wrapper function that calls the async snapsave downloader and saves the file into the job's workspace.
+    An already resolved `download_url` skips the SnapSave lookup.
+    """
     try:
         print("Starting video download...")
         
-        # Run the async function
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(download_facebook_video_snapsave(video_url))
-        
-        if not result['success']:
-            raise Exception(f"SnapSave failed: {result['error']}")
-        
-        download_url = result['download_url']
+        if not download_url:
+            download_url = resolve_download_url(video_url)
         print("Download URL obtained, downloading video file...")
         
         # Now download the file from the URL
-        import requests
-        import tempfile
-        
-        response = requests.get(download_url, stream=True, timeout=120)
-        response.raise_for_status()
-        
-        # Create a temporary file for the video
-        temp_dir = tempfile.gettempdir()
-        video_file_path = os.path.join(temp_dir, f"freefbzone_video_{os.getpid()}.mp4")
-        
-        with open(video_file_path, 'wb') as video_file:
-            for chunk in response.iter_content(chunk_size=8192):
-                video_file.write(chunk)
+        video_file_path = workspace.file('source.mp4')
+        partial = PartialDownload(video_file_path)
+        start = time.perf_counter()
+        downloaded_bytes = 0
+        for refresh in range(URL_REFRESHES + 1):
+            try:
+                # Parallel byte ranges when the CDN supports them, a single stream otherwise.
+                # Dropped connections resume from `partial` inside download_file.
+                with DOWNLOAD_LIMITER.slot():
+                    downloaded_bytes += download_file(download_url, video_file_path, reserve=workspace.reserve, partial=partial)
+                break
+            except UrlExpiredError:
+                if refresh >= URL_REFRESHES:
+                    raise Exception("Download URL keeps expiring")
+                # Only an expired signature needs a new SnapSave run; the bytes already written are kept
+                print("[DOWNLOAD] Signed URL expired, resolving a fresh one to resume...")
+                metrics.DOWNLOAD_URL_REFRESHES.inc()
+                download_url = resolve_download_url(video_url, refresh=True)
+        elapsed = time.perf_counter() - start
+        workspace.source_hash = partial.content_hash()
+        metrics.CDN_DOWNLOAD_SECONDS.observe(elapsed)
+        metrics.CDN_DOWNLOAD_BYTES.inc(downloaded_bytes)
+        if elapsed > 0:
+            metrics.CDN_DOWNLOAD_THROUGHPUT.observe(downloaded_bytes / elapsed)
         
         print(f"Video downloaded successfully: {os.path.basename(video_file_path)}")
         return video_file_path
         
+    except OverloadedError:
+        raise
     except Exception as e:
         raise Exception(f"Failed to download video: {str(e)}")
 
-def download_video(video_url):
+def reuse_source_outputs(cache, workspace, profiles, clip=None):
+    """
+    Link outputs already transcoded from the same source bytes (reached through any URL)
+    into the workspace. Returns their paths in `profiles` order, or None unless all exist.
+    """
+    import shutil
+    
+    if not cache or not workspace.source_hash:
+        return None
+    found = [cache.find_source(workspace.source_hash, profile_key(audio_format, bitrate, clip)) for audio_format, bitrate in profiles]
+    if not all(found):
+        return None
+    
+    audio_file_paths = []
+    for index, ((audio_format, _), cached_path) in enumerate(zip(profiles, found)):
+        audio_file_path = workspace.file(f'reused-{index}.{audio_format}')
+        try:
+            os.link(cached_path, audio_file_path)
+        except OSError:
+            shutil.copyfile(cached_path, audio_file_path)
+        audio_file_paths.append(audio_file_path)
+    workspace.sync()
+    metrics.SOURCE_DEDUP_HITS.inc()
+    print(f"[DEDUP] Same video already converted, reusing {len(audio_file_paths)} output(s) of source {workspace.source_hash[:12]}")
+    return audio_file_paths
+
+def download_video(video_url, workspace):
     try:
         # Use our local download_from_snapsave function
-        video_file_path = download_from_snapsave(video_url)
+        video_file_path = download_from_snapsave(video_url, workspace)
         return video_file_path
+    except OverloadedError:
+        raise
     except Exception as e:
         raise Exception(f"Failed to download video: {str(e)}")
 
 # Function to convert video to audio using FFmpeg (local conversion)
-def convert_video_to_audio_local(video_file_path):
+def convert_video_to_audio_local(video_file_path, workspace, audio_format=AUDIO_FORMAT, bitrate=AUDIO_BITRATE):
+    return convert_video_to_audio_local_multi(video_file_path, workspace, [(audio_format, bitrate)])[0]
+
+def convert_video_to_audio_local_multi(video_file_path, workspace, profiles, clip=None):
+    """
+    Produce one audio file per (format, bitrate) profile from a single FFmpeg run:
+    the source is demuxed and decoded once and fanned out to every output.
+    `clip` is an optional (start, end) in seconds (end may be None). The seek is an
+    input option, so when `video_file_path` is a CDN URL FFmpeg only fetches the
+    byte ranges around the clip.
+    Returns the output paths in the same order as `profiles`.
+    """
     try:
         import subprocess
         
-        # Create a temporary file for the audio
-        temp_dir = tempfile.gettempdir()
-        audio_file_path = os.path.join(temp_dir, f"freefbzone_audio_{os.getpid()}.mp3")
-        
-        print("Converting video to audio using FFmpeg...")
-        
-        # FFmpeg command to convert video to MP3 with reduced verbosity
+        if clip:
+            # Cuts are re-encoded so they start exactly at `start`, not at the previous keyframe
+            start_seconds, end_seconds = clip
+            source_codec = None
+            duration = end_seconds - start_seconds if end_seconds is not None else None
+        else:
+            # Remux when the source codec already matches the requested format, transcode otherwise
+            source_codec, duration = probe_media(video_file_path)
+        outputs = []
+        for index, (audio_format, bitrate) in enumerate(profiles):
+            codec_args = ffmpeg_audio_args(audio_format, bitrate, source_codec)
+            outputs.append((workspace.file(f'audio-{index}.{audio_format}'), audio_format, codec_args))
+        mode = 'copy' if all(codec_args == ['-c:a', 'copy'] for _, _, codec_args in outputs) else 'transcode'
+        profile_names = ', '.join(f"{audio_format}@{bitrate}" for audio_format, bitrate in profiles)
+        print(f"Converting video to {profile_names} using FFmpeg ({mode}, source codec: {source_codec or 'unknown'}, "
+              f"duration: {f'{duration:.0f}s' if duration else 'unknown'})...")
+        
+        # FFmpeg command to extract the audio track with reduced verbosity
         ffmpeg_cmd = [
             'ffmpeg',
-            '-i', video_file_path,  # Input video file
-            '-vn',  # No video
-            '-acodec', 'libmp3lame',  # MP3 codec
-            '-ab', '192k',  # Audio bitrate
-            '-ar', '44100',  # Audio sample rate
-            '-y',  # Overwrite output file
+            '-y',  # Overwrite output files
             '-loglevel', 'error',  # Reduce FFmpeg verbosity
-            audio_file_path  # Output audio file
+            '-threads', str(FFMPEG_THREADS),  # Decoder share of the cores
         ]
-        
-        # Execute FFmpeg command
-        result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=300)
+        if clip:
+            ffmpeg_cmd += ['-ss', format_seconds(start_seconds)]  # Seek the input before reading it
+            if end_seconds is not None:
+                ffmpeg_cmd += ['-to', format_seconds(end_seconds)]
+        ffmpeg_cmd += [
+            '-i', video_file_path,  # Input video file (or CDN URL)
+        ]
+        for audio_file_path, audio_format, codec_args in outputs:
+            ffmpeg_cmd += [
+                '-map', '0:a:0',  # Each output takes the same decoded audio track
+                '-vn',  # No video
+            ] + codec_args + [
+                '-threads', str(FFMPEG_THREADS),  # Encoder share of the cores
+                '-f', OUTPUT_FORMATS[audio_format]['muxer'],  # Output container
+            ] + (['-movflags', '+faststart'] if audio_format == 'm4a' else []) + [  # Index up front for ranged playback
+                audio_file_path  # Output audio file
+            ]
+        
+        # Execute FFmpeg command (concurrent FFmpeg processes are limited, see admission.py).
+        # Shorter clips are admitted first so a long video can't hold up quick jobs queued behind it.
+        with FFMPEG_LIMITER.slot(priority=duration if duration is not None else UNKNOWN_DURATION_PRIORITY):
+            start = time.perf_counter()
+            result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True, timeout=300)
+        outcome = 'success' if result.returncode == 0 else 'failure'
+        metrics.FFMPEG_TRANSCODE_SECONDS.observe(time.perf_counter() - start, outcome=outcome, mode=mode)
         
         if result.returncode != 0:
             raise Exception(f"FFmpeg conversion failed: {result.stderr}")
         
-        if not os.path.exists(audio_file_path):
-            raise Exception("Audio file was not created")
+        for audio_file_path, _, _ in outputs:
+            if not os.path.exists(audio_file_path):
+                raise Exception("Audio file was not created")
+        workspace.sync()
         
-        print(f"Audio conversion completed: {os.path.basename(audio_file_path)}")
-        return audio_file_path
+        print(f"Audio conversion completed: {', '.join(os.path.basename(path) for path, _, _ in outputs)}")
+        return [audio_file_path for audio_file_path, _, _ in outputs]
         
+    except OverloadedError:
+        raise
     except FileNotFoundError:
         raise Exception("FFmpeg not found. Please install FFmpeg and add it to your PATH")
     except subprocess.TimeoutExpired:
@@ -111,119 +323,265 @@ def convert_video_to_audio_local(video_file_path):
         raise Exception(f"Local conversion failed: {str(e)}")
 
 # Function to upload the video to the conversion site and download audio
-def convert_video_to_audio(video_file_path):
+def convert_video_to_audio(video_file_path, workspace):
     try:
-        import time
-        
-        # Create a temporary file for the audio
-        temp_dir = tempfile.gettempdir()
-        audio_file_path = os.path.join(temp_dir, f"freefbzone_audio_{os.getpid()}.mp3")
-        
         print("Uploading video to conversion service...")
-        
-        # Step 1: Upload video to conversion service
-        upload_url = 'https://videotomp3.onrender.com/upload'
-        
-        with open(video_file_path, 'rb') as video_file:
-            files = {'file': ('video.mp4', video_file, 'video/mp4')}
-            upload_response = requests.post(upload_url, files=files, timeout=180)
-        
-        if upload_response.status_code != 200:
-            raise Exception(f"Upload failed with status {upload_response.status_code}: {upload_response.text}")
-        
-        # Parse upload response to get job_id
-        try:
-            upload_data = upload_response.json()
-            job_id = upload_data.get('job_id')
-            if not job_id:
-                raise Exception("No job_id received from upload response")
-        except Exception as e:
-            raise Exception(f"Failed to parse upload response: {str(e)}")
-        
-        print(f"Upload successful! Processing conversion...")
-        
-        # Step 2: Poll for conversion status
-        status_url = f'https://videotomp3.onrender.com/status/{job_id}'
-        max_attempts = 60  # Wait up to 5 minutes (60 * 5 seconds)
-        attempt = 0
-        
-        while attempt < max_attempts:
-            try:
-                status_response = requests.get(status_url, timeout=30)
-                if status_response.status_code == 200:
-                    status_data = status_response.json()
-                    status = status_data.get('status', 'unknown')
-                    
-                    if status == 'completed':
-                        print("Conversion completed! Downloading audio...")
-                        break
-                    elif status == 'failed':
-                        error_msg = status_data.get('error', 'Unknown conversion error')
-                        raise Exception(f"Conversion failed: {error_msg}")
-                    elif status in ['processing', 'pending']:
-                        if attempt % 6 == 0:  # Print status every 30 seconds (6 * 5 seconds)
-                            print(f"Converting... ({attempt * 5}s elapsed)")
-                        time.sleep(5)  # Wait 5 seconds before next check
-                    else:
-                        time.sleep(5)
-                else:
-                    time.sleep(5)
-                    
-            except requests.exceptions.RequestException as e:
-                if attempt % 6 == 0:  # Print error every 30 seconds
-                    print(f"Connection issue, retrying... ({attempt * 5}s elapsed)")
-                time.sleep(5)
-            
-            attempt += 1
-        
-        if attempt >= max_attempts:
-            raise Exception("Conversion timeout - took longer than expected")
-        
-        # Step 3: Download the converted MP3 file
-        download_url = f'https://videotomp3.onrender.com/download/{job_id}'
-        print("Downloading converted audio...")
-        
-        download_response = requests.get(download_url, timeout=120, stream=True)
-        
-        if download_response.status_code != 200:
-            raise Exception(f"Download failed with status {download_response.status_code}")
-        
-        # Save the MP3 file
-        with open(audio_file_path, 'wb') as audio_file:
-            for chunk in download_response.iter_content(chunk_size=8192):
-                if chunk:
-                    audio_file.write(chunk)
-        
+        # Upload, status polling and download run on the shared asyncio loop in remote_convert
+        # with a pooled session; this thread waits for the result
+        audio_file_path = remote_convert.convert(video_file_path, workspace.file('audio.mp3'), reserve=workspace.reserve)
         print(f"Audio saved: {os.path.basename(audio_file_path)}")
         return audio_file_path
-        
     except Exception as e:
         raise Exception(f"Failed to convert video to audio: {str(e)}")
 
+def convert_video_to_audio_async(video_file_path, workspace):
+    """
+    Start the external conversion without waiting for it and return a
+    concurrent.futures.Future of the MP3 path, so no thread is held while it runs
+    """
+    print("Uploading video to conversion service (handed off)...")
+    return remote_convert.submit(video_file_path, workspace.file('audio.mp3'), reserve=workspace.reserve)
+
+class _AudioStream:
+    """Iterator over streamed audio chunks that always releases its resources on close()"""
+    
+    def __init__(self, chunks, on_close):
+        self.chunks = chunks
+        self.on_close = on_close
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        return next(self.chunks)
+    
+    def close(self):
+        # The WSGI server calls close() even if iteration never started
+        self.chunks.close()
+        self.on_close()
+
+# Function to stream audio straight from the CDN through FFmpeg without temp files
+def stream_audio(video_url, audio_format=AUDIO_FORMAT, bitrate=AUDIO_BITRATE, chunk_size=65536):
+    """
+    Pipe the CDN response body into FFmpeg's stdin and return an iterator over
+    FFmpeg's MP3 output, so download and encoding overlap and nothing touches disk.
+    The first chunk is produced before returning so failures (e.g. an MP4 whose
+    moov atom is at the end and can't be read from a pipe) surface as exceptions
+    the caller can fall back from.
+    """
+    import subprocess
+    import threading
+    
+    print(f"[STREAM] Starting streaming extraction from: {video_url[:50]}...")
+    download_url = resolve_download_url(video_url)
+    
+    # A stream holds a download and an FFmpeg slot for its whole lifetime; a client is
+    # waiting on the first bytes, so it goes ahead of queued file conversions
+    DOWNLOAD_LIMITER.acquire()
+    try:
+        FFMPEG_LIMITER.acquire(priority=0)
+    except OverloadedError:
+        DOWNLOAD_LIMITER.release()
+        raise
+    
+    released = []
+    
+    def release_slots():
+        if not released:
+            released.append(True)
+            FFMPEG_LIMITER.release()
+            DOWNLOAD_LIMITER.release()
+    
+    try:
+        response = requests.get(download_url, stream=True, timeout=120)
+        if response.status_code in EXPIRED_STATUSES:
+            # A cached URL that stopped working early; the file pipeline fallback resolves a new one
+            url_cache.invalidate(video_url)
+        response.raise_for_status()
+    except Exception:
+        release_slots()
+        raise
+    
+    # The source can't be probed ahead of a pipe; Facebook audio is AAC, so m4a is remuxed
+    # and anything else fails on the first chunk and falls back to the file pipeline
+    codec_args = ffmpeg_audio_args(audio_format, bitrate, 'aac' if audio_format == 'm4a' else None)
+    muxer_args = ['-f', OUTPUT_FORMATS[audio_format]['muxer']]  # Container must be explicit when writing to a pipe
+    if audio_format == 'm4a':
+        muxer_args += ['-movflags', 'frag_keyframe+empty_moov']  # MP4 needs a fragmented layout on a pipe
+    
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-threads', str(FFMPEG_THREADS),
+        '-i', 'pipe:0',  # Video from stdin
+        '-vn',  # No video
+    ] + codec_args + ['-threads', str(FFMPEG_THREADS)] + muxer_args + [
+        '-loglevel', 'error',  # Reduce FFmpeg verbosity
+        'pipe:1'  # Audio to stdout
+    ]
+    
+    try:
+        process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        response.close()
+        release_slots()
+        raise Exception("FFmpeg not found. Please install FFmpeg and add it to your PATH")
+    
+    stderr_lines = []
+    
+    def feed_stdin():
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    process.stdin.write(chunk)
+        except Exception:
+            pass  # FFmpeg exited early or the download broke; the return code tells the caller
+        finally:
+            response.close()
+            try:
+                process.stdin.close()
+            except Exception:
+                pass
+    
+    def drain_stderr():
+        for line in process.stderr:
+            stderr_lines.append(line.decode('utf-8', errors='replace'))
+    
+    threading.Thread(target=feed_stdin, daemon=True).start()
+    threading.Thread(target=drain_stderr, daemon=True).start()
+    
+    first_chunk = process.stdout.read(chunk_size)
+    if not first_chunk:
+        process.wait()
+        release_slots()
+        raise Exception(f"FFmpeg streaming failed: {''.join(stderr_lines)[:200]}")
+    
+    def finish():
+        # Client disconnected or stream finished: make sure nothing is left running
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        response.close()
+        if not released:
+            release_slots()
+            metrics.STREAMS_IN_FLIGHT.dec()
+    
+    def generate():
+        try:
+            yield first_chunk
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            if process.wait() != 0:
+                print(f"[ERROR] FFmpeg stream ended with errors: {''.join(stderr_lines)[:200]}")
+            else:
+                print("[SUCCESS] Audio stream completed")
+        finally:
+            finish()
+    
+    metrics.STREAMS_IN_FLIGHT.inc()
+    return _AudioStream(generate(), finish)
+
 # Main function to execute the steps
-def main(video_url):
+def main(video_url, progress=None, audio_format=AUDIO_FORMAT, bitrate=AUDIO_BITRATE, workspace=None, profiles=None, clip=None, cache=None, handoff=False):
+    """
+    Download a Facebook video and extract its audio as `audio_format` (see OUTPUT_FORMATS).
+    With `profiles`, a list of (format, bitrate) pairs, every profile is produced from one
+    decode and a list of files is returned in the same order.
+    With `clip`, a (start, end) pair in seconds, only that part of the video is extracted.
+    With `cache` (an AudioCache), outputs already made from identical source bytes are
+    reused instead of running FFmpeg again.
+    `progress` is an optional callback(stage, percent) used by the job queue to report status.
+    The returned file lives in `workspace`, which the caller cleans up. Without one,
+    a private workspace is used and the result is moved out of it before it is removed.
+    With `handoff`, a fallback to the external service returns a concurrent.futures.Future
+    of the file instead of waiting for it; the caller keeps `workspace` until it is done.
+    """
+    if workspace is None:
+        with get_scratch_manager().workspace() as own_workspace:
+            result = main(video_url, progress, audio_format, bitrate, own_workspace, profiles, clip, cache)
+            if profiles:
+                return [own_workspace.keep(path) for path in result]
+            return own_workspace.keep(result)
+    
+    def report(stage, percent):
+        if progress:
+            try:
+                progress(stage, percent)
+            except Exception:
+                pass  # Never let status reporting break the pipeline
+
     try:
         print(f"[MUSIC] Starting audio extraction from: {video_url[:50]}...")
         
-        # Step 1: Download video
-        print("[DOWNLOAD] Step 1: Downloading video...")
-        video_file_path = download_video(video_url)
+        if clip:
+            # FFmpeg seeks straight into the CDN file, fetching only the ranges the clip needs
+            print(f"[CLIP] Extracting {format_seconds(clip[0])}s to {format_seconds(clip[1]) + 's' if clip[1] is not None else 'the end'}...")
+            report('downloading', 10)
+            download_url = resolve_download_url(video_url)
+            report('converting', 40)
+            try:
+                with DOWNLOAD_LIMITER.slot():
+                    audio_file_paths = convert_video_to_audio_local_multi(download_url, workspace, profiles or [(audio_format, bitrate)], clip)
+                report('finalizing', 95)
+                return audio_file_paths if profiles else audio_file_paths[0]
+            except OverloadedError:
+                raise
+            except Exception as seek_error:
+                # e.g. a CDN that ignores Range: cut the clip from a full download instead
+                print(f"[CLIP] Remote seek failed, downloading the whole video: {str(seek_error)[:100]}")
+                metrics.FALLBACKS.inc(source='clip_seek', target='download')
+                report('downloading', 50)
+                video_file_path = download_from_snapsave(video_url, workspace, download_url)
+        else:
+            # Step 1: Download video
+            print("[DOWNLOAD] Step 1: Downloading video...")
+            report('downloading', 10)
+            video_file_path = download_video(video_url, workspace)
+        
+        # The same video may already have been converted after being downloaded through another URL
+        reused_paths = reuse_source_outputs(cache, workspace, profiles or [(audio_format, bitrate)], clip)
+        if reused_paths:
+            report('finalizing', 95)
+            workspace.release(video_file_path)
+            return reused_paths if profiles else reused_paths[0]
         
         # Step 2: Convert to audio (try local FFmpeg first for speed, then external service as fallback)
         print("[CONVERT] Step 2: Converting to audio...")
+        report('converting', 60)
         audio_file_path = None
         
+        if profiles or clip:
+            # Every profile comes out of one FFmpeg run; the external service can't do this (or cut clips)
+            audio_file_paths = convert_video_to_audio_local_multi(video_file_path, workspace, profiles or [(audio_format, bitrate)], clip)
+            report('finalizing', 95)
+            workspace.release(video_file_path)
+            return audio_file_paths if profiles else audio_file_paths[0]
+        
         try:
             # Try local FFmpeg conversion first (much faster - no upload needed)
             print("[LOCAL] Trying local FFmpeg conversion...")
-            audio_file_path = convert_video_to_audio_local(video_file_path)
+            audio_file_path = convert_video_to_audio_local(video_file_path, workspace, audio_format, bitrate)
+        except OverloadedError:
+            raise
         except Exception as local_error:
             print(f"[ERROR] Local FFmpeg failed: {str(local_error)[:100]}...")
+            if audio_format != 'mp3':
+                # The external service only produces MP3
+                raise
             print("[CLOUD] Falling back to external conversion service...")
+            metrics.FALLBACKS.inc(source='ffmpeg', target='videotomp3')
+            
+            if handoff:
+                # The shared loop uploads, polls and downloads; the caller finishes the job when
+                # the future completes, and removing the workspace also removes the video
+                report('converting', 70)
+                return convert_video_to_audio_async(video_file_path, workspace)
             
             try:
                 # Fallback to external conversion service
-                audio_file_path = convert_video_to_audio(video_file_path)
+                audio_file_path = convert_video_to_audio(video_file_path, workspace)
             except Exception as external_error:
                 raise Exception(f"Both conversion methods failed. Local: {str(local_error)[:50]}... External: {str(external_error)[:50]}...")
         
@@ -231,14 +589,11 @@ def main(video_url):
             raise Exception("No audio file was created")
             
         print(f"[SUCCESS] Audio conversion completed: {os.path.basename(audio_file_path)}")
+        report('finalizing', 95)
         
-        # Step 3: Clean up video file (optional)
-        try:
-            if os.path.exists(video_file_path):
-                os.remove(video_file_path)
-                print("[CLEANUP] Temporary video file cleaned up")
-        except:
-            pass  # Don't fail if cleanup fails
+        # Step 3: Free the video file early (the workspace removes anything left over)
+        workspace.release(video_file_path)
+        print("[CLEANUP] Temporary video file cleaned up")
         
         return audio_file_path
         
@@ -255,7 +610,23 @@ if __name__ == "__main__":
     
     video_url = sys.argv[1]
     try:
-        result = main(video_url)
+        # Keep finished files in the shared cache so server.js can serve them as resumable artifacts
+        from audio_cache import AudioCache, cache_key
+        audio_cache = AudioCache()
+        key = cache_key(video_url, AUDIO_FORMAT, AUDIO_BITRATE)
+        
+        result = audio_cache.get(key)
+        if not result:
+            with get_scratch_manager().workspace() as workspace:
+                result = main(video_url, workspace=workspace, cache=audio_cache)
+                cached_path = audio_cache.put(key, result, move=True)
+                if cached_path:
+                    audio_cache.record_source(workspace.source_hash, key, cached_path)
+                result = cached_path or workspace.keep(result)
+        
+        artifact_id = audio_cache.artifact_id(result)
+        if artifact_id:
+            print(f"Artifact ID: {artifact_id}")
         print(f"Audio file ready: {result}")
     except Exception as e:
         print(f"[ERROR] Failed to process: {e}")
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from fb_uploader import extract_video_id_from_url
+
+# Cache configuration (override through environment variables)
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'freefbzone_cache'))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+# Artifact IDs are the cache file names: sha256 of the key plus the format extension
+ARTIFACT_ID_PATTERN = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]{1,5}$')
+
+
+# Query parameters that identify the post or video in story.php, permalink.php, photo.php, etc.
+IDENTIFYING_QUERY_PARAMS = ('story_fbid', 'fbid', 'id', 'v', 'video_id')
+
+
+def _video_id_from_videos_path(path):
+    """
+    ID in a /videos/ path, skipping the vb.<pageid> album segment of
+    /<page>/videos/vb.<pageid>/<videoid>/ links
+    """
+    segments = [segment for segment in path.split('/') if segment]
+    if 'videos' not in segments:
+        return None
+    candidates = [s for s in segments[segments.index('videos') + 1:] if not s.startswith('vb.')]
+    numeric = [s for s in candidates if s.isdigit()]
+    if numeric:
+        return numeric[0]
+    return candidates[0] if candidates else None
+
+
+def canonical_video_id(video_url):
+    """
+    Normalize the different Facebook video URL formats to a single video ID.
+    Falls back to a hash of the normalized URL (including the query parameters
+    that identify the post) when no ID can be extracted.
+
+    >>> canonical_video_id('https://www.facebook.com/page/videos/vb.123/456/')
+    '456'
+    >>> canonical_video_id('https://www.facebook.com/page/videos/789/')
+    '789'
+    >>> a = canonical_video_id('https://m.facebook.com/story.php?story_fbid=1&id=2')
+    >>> b = canonical_video_id('https://m.facebook.com/story.php?story_fbid=3&id=2')
+    >>> a != b and a.startswith('url-')
+    True
+    >>> a == canonical_video_id('https://www.facebook.com/story.php?id=2&story_fbid=1&mibextid=x')
+    True
+    >>> c = canonical_video_id('facebook.com/permalink.php?story_fbid=1&id=2')
+    >>> c != canonical_video_id('facebook.com/permalink.php?story_fbid=5&id=2')
+    True
+    """
+    url = video_url.strip()
+    if not url.startswith(('http://', 'https://')):
+        url = 'https://' + url
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+
+    if '/videos/' in parsed.path:
+        video_id = _video_id_from_videos_path(parsed.path)
+    else:
+        video_id = extract_video_id_from_url(url)
+
+    # /watch?v=ID (no trailing slash) and other ?v= links are not covered by fb_uploader
+    if not video_id:
+        video_id = query.get('v', [None])[0]
+
+    if video_id:
+        return video_id.split('?')[0].split('#')[0].strip('/')
+
+    host = parsed.netloc.lower()
+    for prefix in ('www.', 'm.', 'web.', 'mbasic.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    # Keep only the identifying parameters so tracking ones (mibextid, rdid, ...) don't split the cache;
+    # if none of them are present, fall back to the whole query rather than dropping it
+    params = {name: values for name, values in query.items() if name in IDENTIFYING_QUERY_PARAMS} or query
+    query_string = '&'.join(f"{name}={value}" for name in sorted(params) for value in sorted(params[name]))
+    normalized = f"{host}{parsed.path.rstrip('/')}"
+    if query_string:
+        normalized += '?' + query_string
+    return 'url-' + hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:20]
+
+
+def format_seconds(seconds):
+    """
+    Millisecond-precision time without trailing zeros, for FFmpeg arguments and cache keys
+
+    >>> format_seconds(12345.678), format_seconds(1234567.0), format_seconds(1.5)
+    ('12345.678', '1234567', '1.5')
+    """
+    return f"{seconds:.3f}".rstrip('0').rstrip('.')
+
+
+def profile_key(audio_format='mp3', bitrate='192k', clip=None):
+    """The output part of a cache key: format, bitrate and the (start, end) of a clip"""
+    key = f"{audio_format}|{bitrate}"
+    if clip:
+        start, end = clip
+        key += f"|{format_seconds(start)}-{format_seconds(end)}" if end is not None else f"|{format_seconds(start)}-"
+    return key
+
+
+def cache_key(video_url, audio_format='mp3', bitrate='192k', clip=None):
+    """Build the cache key for a video URL and output profile, plus the (start, end) of a clip"""
+    return f"{canonical_video_id(video_url)}|{profile_key(audio_format, bitrate, clip)}"
+
+
+class AudioCache:
+    """
+    Size-bounded LRU cache of finished audio files on disk.
+    Files are named after a hash of their key and written atomically.
+    """
+
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # file name -> size, least recently used first
+        self.total_bytes = 0
+        # Links between artifacts produced by the same decode, one small JSON file per artifact
+        self.related_directory = os.path.join(self.directory, 'related')
+        os.makedirs(self.related_directory, exist_ok=True)
+        # Source content hash -> artifacts transcoded from those bytes, whatever URL they came from
+        self.sources_directory = os.path.join(self.directory, 'sources')
+        os.makedirs(self.sources_directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Rebuild the LRU order from the files already on disk"""
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.tmp-'):
+                # Leftover from an interrupted write
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((max(stat.st_atime, stat.st_mtime), name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+
+    def _file_name(self, key):
+        audio_format = key.split('|')[1] if key.count('|') >= 2 else 'mp3'
+        return hashlib.sha256(key.encode('utf-8')).hexdigest() + '.' + audio_format
+
+    def path_for(self, key):
+        return os.path.join(self.directory, self._file_name(key))
+
+    def contains_path(self, path):
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.directory)
+
+    def artifact_id(self, path):
+        """Stable public ID of a cached file, or None if path is not in the cache"""
+        if not path or not self.contains_path(path):
+            return None
+        return os.path.basename(path)
+
+    def artifact_path(self, artifact_id):
+        """Return the cached file for an artifact ID, or None if it is unknown or evicted"""
+        if not ARTIFACT_ID_PATTERN.match(artifact_id or ''):
+            return None
+        return self._touch(artifact_id)
+
+    def get(self, key):
+        """Return the cached file path for key, or None on a miss"""
+        return self._touch(self._file_name(key))
+
+    def _touch(self, name):
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            if not os.path.exists(path):
+                self.total_bytes -= self.entries.pop(name)
+                return None
+            self.entries.move_to_end(name)
+        try:
+            # Persist the recency in atime so the LRU order survives restarts;
+            # mtime is left alone because it backs the artifact's ETag
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, source_path, move=False):
+        """
+        Store source_path under key and return the cached path, or None if it is too large.
+        The file is copied (or moved, if `move`) to a temp file in the cache directory
+        and renamed into place.
+        """
+        size = os.path.getsize(source_path)
+        if size > self.max_bytes:
+            return None
+
+        name = self._file_name(key)
+        path = os.path.join(self.directory, name)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+        os.close(fd)
+        try:
+            moved = False
+            if move:
+                try:
+                    # A rename is free when the source is on the same filesystem
+                    os.replace(source_path, tmp_path)
+                    moved = True
+                except OSError:
+                    pass
+            if not moved:
+                shutil.copyfile(source_path, tmp_path)
+                if move:
+                    os.remove(source_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self.lock:
+            if name in self.entries:
+                self.total_bytes -= self.entries.pop(name)
+            self.entries[name] = size
+            self.total_bytes += size
+            self._evict()
+        print(f"[CACHE] Stored {key} ({size // 1024} KB)")
+        return path
+
+    def relate(self, keys):
+        """Record that the cached files for `keys` are outputs of the same source"""
+        members = []
+        for key in keys:
+            audio_format, bitrate = key.split('|')[1:3]
+            members.append({'artifactId': self._file_name(key), 'format': audio_format, 'bitrate': bitrate})
+        for member in members:
+            others = [other for other in members if other is not member]
+            path = os.path.join(self.related_directory, member['artifactId'] + '.json')
+            try:
+                with open(path, 'w') as related_file:
+                    json.dump(others, related_file)
+            except OSError as e:
+                print(f"[CACHE] Warning: could not link related artifacts: {str(e)[:100]}")
+
+    def related(self, artifact_id):
+        """Other cached artifacts produced together with artifact_id (evicted ones are left out)"""
+        if not ARTIFACT_ID_PATTERN.match(artifact_id or ''):
+            return []
+        try:
+            with open(os.path.join(self.related_directory, artifact_id + '.json')) as related_file:
+                members = json.load(related_file)
+        except (OSError, ValueError):
+            return []
+        with self.lock:
+            return [member for member in members if member.get('artifactId') in self.entries]
+
+    def record_source(self, content_hash, key, path):
+        """Remember that the cached file at path (stored under key) was made from the source content_hash"""
+        artifact_id = self.artifact_id(path)
+        if not content_hash or not artifact_id:
+            return
+        index_path = os.path.join(self.sources_directory, content_hash + '.json')
+        with self.lock:
+            try:
+                with open(index_path) as index_file:
+                    outputs = json.load(index_file)
+            except (OSError, ValueError):
+                outputs = {}
+            outputs[key.split('|', 1)[1]] = artifact_id
+            try:
+                fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.sources_directory)
+                with os.fdopen(fd, 'w') as index_file:
+                    json.dump(outputs, index_file)
+                os.replace(tmp_path, index_path)
+            except OSError as e:
+                print(f"[CACHE] Warning: could not index source: {str(e)[:100]}")
+
+    def find_source(self, content_hash, output_profile):
+        """Cached file made from the source content_hash with the given profile_key(), or None"""
+        if not content_hash:
+            return None
+        try:
+            with open(os.path.join(self.sources_directory, content_hash + '.json')) as index_file:
+                artifact_id = json.load(index_file).get(output_profile)
+        except (OSError, ValueError):
+            return None
+        return self.artifact_path(artifact_id) if artifact_id else None
+
+    def _evict(self):
+        """Drop least recently used files until the cache fits. Caller holds the lock."""
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            for path in (os.path.join(self.directory, name), os.path.join(self.related_directory, name + '.json')):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            print(f"[CACHE] Evicted {name[:12]} ({size // 1024} KB)")
@@ -0,0 +1,103 @@
+import json
+import os
+import time
+import zipfile
+from collections import deque
+
+from jobs import QueueFullError, STATUS_COMPLETED
+
+# Batch configuration (override through environment variables)
+BATCH_MAX_URLS = int(os.getenv('AUDIO_BATCH_MAX_URLS', '200'))
+BATCH_DEFAULT_PARALLELISM = int(os.getenv('AUDIO_BATCH_PARALLELISM', '4'))
+BATCH_MAX_PARALLELISM = int(os.getenv('AUDIO_BATCH_MAX_PARALLELISM', '16'))
+# Give up on a single URL after this many seconds
+BATCH_JOB_TIMEOUT = int(os.getenv('AUDIO_BATCH_JOB_TIMEOUT', '600'))
+
+
+class _ZipStream:
+    """Write-only, unseekable file object that collects bytes for a streaming response"""
+
+    def __init__(self):
+        self.buffer = []
+        self.offset = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        return data
+
+
+def stream_batch_zip(job_manager, video_urls, key_for, parallelism=BATCH_DEFAULT_PARALLELISM,
+                     audio_format='mp3', options=None, chunk_size=1024 * 1024):
+    """
+    Run an audio job per URL, keeping at most `parallelism` in flight, and yield
+    a ZIP archive that gets each file as soon as its job finishes.
+    A manifest.json listing every URL's outcome is added last.
+    `parallelism` is capped at the manager's worker count: more jobs in flight would
+    not run any sooner and would only take shared queue slots from interactive requests.
+    """
+    parallelism = max(1, min(parallelism, job_manager.workers))
+    pending = deque(enumerate(video_urls, start=1))
+    active = []  # (index, url, job, submitted_at)
+    manifest = []
+    stream = _ZipStream()
+
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        while pending or active:
+            # Keep the pipeline full, backing off while the shared queue is saturated
+            while pending and len(active) < parallelism:
+                index, url = pending[0]
+                try:
+                    job = job_manager.submit(url, key_for(url), options)
+                except QueueFullError:
+                    if not active:
+                        time.sleep(1)
+                    break
+                pending.popleft()
+                active.append((index, url, job, time.time()))
+
+            finished = [entry for entry in active if entry[2].done.is_set() or time.time() - entry[3] > BATCH_JOB_TIMEOUT]
+            if not finished:
+                time.sleep(0.2)
+                continue
+
+            for entry in finished:
+                active.remove(entry)
+                index, url, job, _ = entry
+                if not job.done.is_set():
+                    manifest.append({'index': index, 'url': url, 'status': 'failed', 'error': 'Timed out'})
+                    continue
+                if job.status != STATUS_COMPLETED or not job.result_path or not os.path.exists(job.result_path):
+                    manifest.append({'index': index, 'url': url, 'status': 'failed', 'error': job.error or 'Failed to process audio'})
+                    continue
+
+                name = f"{index:03d}_freefbzone_audio.{audio_format}"
+                info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                info.file_size = os.path.getsize(job.result_path)
+                with open(job.result_path, 'rb') as source, archive.open(info, 'w') as target:
+                    while True:
+                        chunk = source.read(chunk_size)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield stream.drain()
+                yield stream.drain()
+                manifest.append({'index': index, 'url': url, 'status': 'completed', 'file': name})
+                print(f"[BATCH] Added {name} ({len(manifest)}/{len(video_urls)})")
+
+        manifest.sort(key=lambda item: item['index'])
+        failed = sum(1 for item in manifest if item['status'] != 'completed')
+        archive.writestr('manifest.json', json.dumps({'total': len(video_urls), 'failed': failed, 'items': manifest}, indent=2))
+
+    yield stream.drain()
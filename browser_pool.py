@@ -0,0 +1,279 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import event_loop
+import metrics
+from admission import OverloadedError, estimate_retry_after
+
+# Browser pool configuration (override through environment variables)
+CHROME_PATH = os.getenv('AUDIO_CHROME_PATH', '/usr/bin/google-chrome')
+BROWSER_POOL_SIZE = int(os.getenv('AUDIO_BROWSER_POOL_SIZE', '1'))
+CONTEXTS_PER_BROWSER = int(os.getenv('AUDIO_CONTEXTS_PER_BROWSER', '2'))
+# A browser is replaced after this many jobs or once its processes use this much memory
+BROWSER_MAX_JOBS = int(os.getenv('AUDIO_BROWSER_MAX_JOBS', '50'))
+BROWSER_MAX_RSS_MB = int(os.getenv('AUDIO_BROWSER_MAX_RSS_MB', '1024'))
+HEALTH_CHECK_SECONDS = int(os.getenv('AUDIO_BROWSER_HEALTH_CHECK', '30'))
+# Longest a lookup waits for a free context before it is rejected with a Retry-After
+POOL_MAX_WAIT_SECONDS = int(os.getenv('AUDIO_MAX_STAGE_WAIT', '120'))
+# Typical lookup time, the starting point for Retry-After estimates
+POOL_EXPECTED_SECONDS = 30
+
+
+def _process_tree_rss(pid):
+    """Resident memory in bytes of pid and all of its descendants, or None where /proc isn't available"""
+    if not pid or not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as stat_file:
+                # The command name may contain spaces, so split after its closing parenthesis
+                parent = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(name))
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/statm') as statm_file:
+                total += int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def _find_browser_pid(marker):
+    """PID of the Chrome process launched with our marker switch"""
+    if not os.path.isdir('/proc'):
+        return None
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/cmdline', 'rb') as cmdline_file:
+                if marker.encode() in cmdline_file.read():
+                    return int(name)
+        except OSError:
+            continue
+    return None
+
+
+class _PooledBrowser:
+    def __init__(self, browser, marker):
+        self.browser = browser
+        self.marker = marker
+        self.pid = None  # Found off the event loop once launched, see BrowserPool._launch
+        self.active = 0
+        self.jobs = 0
+        self.retiring = None  # Reason the browser is being replaced, once it is
+        self.started_at = time.time()
+
+    def healthy(self):
+        return self.browser.is_connected() and not self.retiring
+
+    def rss(self):
+        return _process_tree_rss(self.pid)
+
+
+class BrowserPool:
+    """
+    Long-lived headless Chrome instances shared by all SnapSave lookups. Each job
+    gets a fresh, isolated browser context (no cookies or cache shared between jobs),
+    up to `contexts_per_browser` at a time per browser. Browsers are recycled after
+    `max_jobs` jobs, when their process tree grows past `max_rss_mb`, or when they
+    crash. A lookup that waits longer than `max_wait_seconds` for a context is
+    rejected with an OverloadedError, like the admission stages.
+    All Playwright objects live on the shared event loop (see event_loop.py).
+    """
+
+    def __init__(self, size=BROWSER_POOL_SIZE, contexts_per_browser=CONTEXTS_PER_BROWSER,
+                 max_jobs=BROWSER_MAX_JOBS, max_rss_mb=BROWSER_MAX_RSS_MB, executable_path=CHROME_PATH,
+                 max_wait_seconds=POOL_MAX_WAIT_SECONDS):
+        self.size = max(1, size)
+        self.contexts_per_browser = max(1, contexts_per_browser)
+        self.max_wait_seconds = max_wait_seconds
+        self.waiting = 0
+        self.average_seconds = float(POOL_EXPECTED_SECONDS)
+        self.max_jobs = max_jobs
+        self.max_rss_bytes = max_rss_mb * 1024 * 1024
+        self.executable_path = executable_path
+        self.browsers = []
+        self.launching = 0
+        self.playwright = None
+        self.condition = None
+        self.loop = event_loop.get_loop()
+        event_loop.run(self._start())
+        event_loop.on_shutdown(self._close)
+
+    async def _start(self):
+        from playwright.async_api import async_playwright
+        self.condition = asyncio.Condition()
+        self.playwright = await async_playwright().start()
+        self.loop.create_task(self._health_check_loop())
+
+    async def _launch(self):
+        # A unique dummy switch lets us find this browser's process to measure its memory
+        marker = f"--freefbzone-pool={uuid.uuid4().hex[:12]}"
+        options = {'headless': True, 'args': [marker]}
+        if self.executable_path and os.path.exists(self.executable_path):
+            options['executable_path'] = self.executable_path
+        start = time.perf_counter()
+        browser = await self.playwright.chromium.launch(**options)
+        pooled = _PooledBrowser(browser, marker)
+        # Scanning /proc is blocking file I/O; keep it off the shared event loop
+        pooled.pid = await self.loop.run_in_executor(None, _find_browser_pid, marker)
+        browser.on('disconnected', lambda _: self.loop.create_task(self._discard(pooled, 'disconnected')))
+        metrics.BROWSER_LAUNCHES.inc()
+        print(f"[BROWSER] Launched pooled browser in {time.perf_counter() - start:.1f}s ({len(self.browsers) + 1}/{self.size})")
+        return pooled
+
+    @property
+    def capacity(self):
+        """Lookups the pool can run at once"""
+        return self.size * self.contexts_per_browser
+
+    async def _acquire(self):
+        deadline = self.loop.time() + self.max_wait_seconds
+        async with self.condition:
+            while True:
+                candidates = [pooled for pooled in self.browsers if pooled.healthy() and pooled.active < self.contexts_per_browser]
+                if candidates:
+                    pooled = min(candidates, key=lambda candidate: candidate.active)
+                    pooled.active += 1
+                    return pooled
+                if len(self.browsers) + self.launching < self.size:
+                    self.launching += 1
+                    break
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    metrics.STAGE_REJECTIONS.inc(stage='browser_pool')
+                    raise OverloadedError(
+                        "Server is busy (browser pool at capacity). Please try again later.",
+                        estimate_retry_after(self.waiting, self.average_seconds, self.capacity)
+                    )
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self.condition.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass  # Checked again at the top of the loop
+                finally:
+                    self.waiting -= 1
+        try:
+            pooled = await self._launch()
+        finally:
+            async with self.condition:
+                self.launching -= 1
+                self.condition.notify_all()
+        async with self.condition:
+            pooled.active += 1
+            self.browsers.append(pooled)
+            self._update_gauge()
+        return pooled
+
+    async def _release(self, pooled, elapsed=None):
+        async with self.condition:
+            pooled.active -= 1
+            if elapsed is not None:
+                self.average_seconds = 0.8 * self.average_seconds + 0.2 * elapsed
+            pooled.jobs += 1
+            if pooled.jobs >= self.max_jobs and not pooled.retiring:
+                pooled.retiring = 'jobs'
+            self.condition.notify_all()
+        if pooled.retiring and pooled.active == 0:
+            await self._discard(pooled, pooled.retiring, f"served {pooled.jobs} jobs")
+
+    async def _discard(self, pooled, reason, detail=''):
+        async with self.condition:
+            if pooled not in self.browsers:
+                return
+            self.browsers.remove(pooled)
+            self._update_gauge()
+            self.condition.notify_all()
+        print(f"[BROWSER] Closing pooled browser ({reason}{': ' + detail if detail else ''})")
+        metrics.BROWSER_RECYCLES.inc(reason=reason)
+        try:
+            await pooled.browser.close()
+        except Exception:
+            pass
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_SECONDS)
+            for pooled in list(self.browsers):
+                if not pooled.browser.is_connected():
+                    await self._discard(pooled, 'disconnected')
+                    continue
+                rss = await self.loop.run_in_executor(None, pooled.rss)
+                if rss is not None and rss > self.max_rss_bytes:
+                    # Stop handing it out; it closes once its running jobs finish
+                    pooled.retiring = 'rss'
+                    if pooled.active == 0:
+                        await self._discard(pooled, 'rss', f"{rss // (1024 * 1024)} MB resident")
+
+    def _update_gauge(self):
+        metrics.BROWSERS_RUNNING.set(len(self.browsers))
+
+    @asynccontextmanager
+    async def context(self, **context_options):
+        """A fresh isolated browser context on a warm browser, closed when the block exits"""
+        pooled = await self._acquire()
+        start = time.perf_counter()
+        context = None
+        try:
+            context = await pooled.browser.new_context(**context_options)
+            yield context
+        finally:
+            if context:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+            await self._release(pooled, time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            'browsers': len(self.browsers),
+            'active_contexts': sum(pooled.active for pooled in self.browsers),
+            'waiting': self.waiting,
+            'jobs': [pooled.jobs for pooled in self.browsers],
+        }
+
+    async def _close(self):
+        for pooled in list(self.browsers):
+            try:
+                await pooled.browser.close()
+            except Exception:
+                pass
+        self.browsers = []
+        if self.playwright:
+            await self.playwright.stop()
+
+    def close(self):
+        event_loop.run(self._close(), timeout=10)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_browser_pool():
+    """Process-wide browser pool, started on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool()
+        return _pool
+
+
+def pool_stats():
+    """Stats of the browser pool, or None if no lookup has started it yet"""
+    return _pool.stats() if _pool is not None else None
@@ -0,0 +1,367 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Segmented download configuration (override through environment variables)
+DOWNLOAD_SEGMENTS = int(os.getenv('AUDIO_DOWNLOAD_SEGMENTS', '4'))
+MIN_SEGMENT_BYTES = int(os.getenv('AUDIO_DOWNLOAD_MIN_SEGMENT_BYTES', str(2 * 1024 * 1024)))
+SEGMENT_RETRIES = int(os.getenv('AUDIO_DOWNLOAD_SEGMENT_RETRIES', '3'))
+CHUNK_SIZE = 64 * 1024
+# Content hashes are computed over blocks of this size; segment boundaries are aligned to it
+HASH_BLOCK_SIZE = 1024 * 1024
+TIMEOUT = 120
+
+# One pooled session so segments (and consecutive downloads) reuse CDN connections
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max(16, DOWNLOAD_SEGMENTS * 4))
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+# Without pwrite (Windows) seek + write must not interleave between threads
+_write_lock = threading.Lock()
+
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+        return
+    with _write_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+
+
+class ContentHasher:
+    """
+    Content hash of a file that is written out of order: sha256 of the concatenated
+    sha256 digests of its fixed-size blocks. Every writer streams its own blocks
+    through the hasher, so parallel segments and resumed transfers hash the bytes as
+    they arrive, and the result doesn't depend on how the download was split.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.blocks = {}  # block index -> digest of a finished block
+        self.pending = {}  # block index -> sha256 of a block still being written
+        self.broken = False
+
+    def update(self, offset, data):
+        with self.lock:
+            while data and not self.broken:
+                index, within = divmod(offset, HASH_BLOCK_SIZE)
+                take = min(len(data), HASH_BLOCK_SIZE - within)
+                block = self.pending.get(index)
+                if block is None:
+                    if within:
+                        # Bytes arrived somewhere other than right after the last ones hashed
+                        self.broken = True
+                        return
+                    block = self.pending[index] = hashlib.sha256()
+                block.update(data[:take])
+                if within + take == HASH_BLOCK_SIZE:
+                    self.blocks[index] = self.pending.pop(index).digest()
+                offset += take
+                data = data[take:]
+
+    def hexdigest(self, total_size):
+        """The file's content hash, or None if some bytes were never hashed in order"""
+        with self.lock:
+            for index, block in list(self.pending.items()):
+                self.blocks[index] = block.digest()  # The final, short block
+            self.pending = {}
+            count = -(-total_size // HASH_BLOCK_SIZE)
+            if self.broken or any(index not in self.blocks for index in range(count)):
+                return None
+            return hashlib.sha256(b''.join(self.blocks[index] for index in range(count))).hexdigest()
+
+
+class UrlExpiredError(Exception):
+    """The signed CDN URL was rejected (403/410); a fresh one has to be resolved to continue"""
+    pass
+
+
+# Statuses Facebook's CDN returns once a signed URL has expired
+EXPIRED_STATUSES = (403, 410)
+
+
+class PartialDownload:
+    """
+    Progress of one download into `path`, kept across retries and URL refreshes
+    so bytes that already arrived are never fetched again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.total_size = None
+        self.etag = None
+        self.ranges = []  # [next offset, last byte] per segment; last byte is None when the size is unknown
+        self.reserved = 0
+        self.hasher = ContentHasher()
+
+    def remaining(self):
+        return sum(end + 1 - offset for offset, end in self.ranges if end is not None)
+
+    def matches(self, total_size, etag):
+        """Whether a (possibly refreshed) URL still serves the same bytes"""
+        if self.total_size is None or total_size != self.total_size:
+            return False
+        return not (self.etag and etag) or self.etag == etag
+
+    def content_hash(self):
+        """Hash of the downloaded bytes (see ContentHasher), or None if the download is incomplete"""
+        if not self.ranges or self.remaining() or any(end is None for _, end in self.ranges):
+            return None
+        return self.hasher.hexdigest(max(end + 1 for _, end in self.ranges))
+
+    def reset(self):
+        self.total_size = None
+        self.etag = None
+        self.ranges = []
+        self.hasher.reset()
+
+
+def _reserve_upto(partial, reserve, nbytes):
+    # Scratch quota is charged once per byte of the file, however often it is rewritten
+    if reserve and nbytes > partial.reserved:
+        reserve(nbytes - partial.reserved)
+        partial.reserved = nbytes
+
+
+def probe(url):
+    """
+    Check whether the server honours byte ranges.
+    Returns (supports_ranges, total_size, etag).
+    """
+    response = _session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=30)
+    try:
+        if response.status_code in EXPIRED_STATUSES:
+            raise UrlExpiredError(f"Download URL rejected with status {response.status_code}")
+        response.raise_for_status()
+        match = _CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+        if response.status_code == 206 and match and match.group(3) != '*':
+            return True, int(match.group(3)), response.headers.get('ETag')
+        length = response.headers.get('Content-Length')
+        return False, int(length) if length and length.isdigit() else None, None
+    finally:
+        response.close()
+
+
+def content_length(url, timeout=10):
+    """Size of the file behind url from a HEAD request (or a one-byte range when HEAD has none), or None"""
+    try:
+        response = _session.head(url, allow_redirects=True, timeout=timeout)
+        if response.status_code in EXPIRED_STATUSES:
+            return None
+        length = response.headers.get('Content-Length')
+        if response.ok and length and length.isdigit() and int(length) > 0:
+            return int(length)
+        return probe(url)[1]
+    except Exception:
+        return None
+
+
+def _download_segment(url, fd, segment, etag, hasher=None):
+    """
+    Fetch segment = [offset, end] into fd, advancing segment[0] as bytes are written
+    so a retry, or a later call with a refreshed URL, resumes where this one stopped.
+    """
+    start = segment[0]
+    end = segment[1]
+    failures = 0
+    while segment[0] <= end:
+        offset = segment[0]
+        headers = {'Range': f'bytes={segment[0]}-{end}'}
+        if etag:
+            headers['If-Range'] = etag
+        try:
+            response = _session.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+            try:
+                if response.status_code in EXPIRED_STATUSES:
+                    raise UrlExpiredError(f"Download URL rejected with status {response.status_code}")
+                if response.status_code != 206:
+                    # A 200 means the ranges (or the If-Range validator) were ignored
+                    raise Exception(f"Range request returned status {response.status_code}")
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    chunk = chunk[:end + 1 - segment[0]]
+                    _pwrite(fd, chunk, segment[0])
+                    if hasher:
+                        hasher.update(segment[0], chunk)
+                    segment[0] += len(chunk)
+                    if segment[0] > end:
+                        break
+            finally:
+                response.close()
+            if segment[0] > end:
+                break
+            raise Exception(f"Segment ended early at byte {segment[0]} of {end}")
+        except UrlExpiredError:
+            raise
+        except Exception as e:
+            # The retry budget only counts attempts that made no progress
+            failures = 1 if segment[0] > offset else failures + 1
+            if failures > SEGMENT_RETRIES:
+                raise Exception(f"Segment {start}-{end} failed: {str(e)}")
+            metrics.DOWNLOAD_SEGMENT_RETRIES.inc()
+            time.sleep(min(2 ** (failures - 1), 8))
+    return segment[0] - start
+
+
+def _download_single(url, partial, reserve=None):
+    """
+    Streamed download for servers without (or with unknown) Range support. After a
+    dropped connection it asks for the rest with a Range request and starts over
+    only if the server insists on sending the whole file again.
+    """
+    if not partial.ranges:
+        partial.ranges = [[0, partial.total_size - 1 if partial.total_size else None]]
+    segment = partial.ranges[0]
+    start = segment[0]
+    failures = 0
+    while True:
+        offset = segment[0]
+        headers = {}
+        if segment[0]:
+            headers['Range'] = f'bytes={segment[0]}-'
+            if partial.etag:
+                headers['If-Range'] = partial.etag
+        try:
+            response = _session.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+            try:
+                if response.status_code in EXPIRED_STATUSES:
+                    raise UrlExpiredError(f"Download URL rejected with status {response.status_code}")
+                response.raise_for_status()
+                if segment[0] and response.status_code != 206:
+                    print("[DOWNLOAD] Server ignored the resume request, starting over")
+                    segment[0] = start = 0
+                    partial.hasher.reset()
+                length = response.headers.get('Content-Length')
+                if segment[1] is None and response.status_code == 200 and length and length.isdigit():
+                    segment[1] = int(length) - 1
+                if segment[1] is not None:
+                    _reserve_upto(partial, reserve, segment[1] + 1)
+                with open(partial.path, 'r+b' if segment[0] else 'wb') as output_file:
+                    output_file.seek(segment[0])
+                    output_file.truncate()
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:
+                            _reserve_upto(partial, reserve, segment[0] + len(chunk))
+                            output_file.write(chunk)
+                            partial.hasher.update(segment[0], chunk)
+                            segment[0] += len(chunk)
+            finally:
+                response.close()
+            if segment[1] is not None and segment[0] <= segment[1]:
+                raise Exception(f"Download ended early at byte {segment[0]} of {segment[1] + 1}")
+            segment[1] = segment[0] - 1
+            return segment[0] - start
+        except UrlExpiredError:
+            raise
+        except Exception as e:
+            failures = 1 if segment[0] > offset else failures + 1
+            if failures > SEGMENT_RETRIES:
+                raise
+            print(f"[DOWNLOAD] Connection dropped at byte {segment[0]}, resuming: {str(e)[:100]}")
+            metrics.DOWNLOAD_SEGMENT_RETRIES.inc()
+            time.sleep(min(2 ** (failures - 1), 8))
+
+
+def download_file(url, path, segments=DOWNLOAD_SEGMENTS, reserve=None, partial=None):
+    """
+    Download url to path, fetching parallel byte ranges over pooled connections
+    when the server supports them. Returns the number of bytes fetched by this call.
+    `reserve(nbytes)` is called before space is used so scratch quotas can be enforced.
+    Pass the same `partial` (a PartialDownload) again after a failure, e.g. with a
+    refreshed URL after UrlExpiredError, to resume instead of starting over.
+    """
+    partial = partial or PartialDownload(path)
+    try:
+        supports_ranges, total_size, etag = probe(url)
+    except UrlExpiredError:
+        raise
+    except Exception as e:
+        print(f"[DOWNLOAD] Range probe failed, using a single stream: {str(e)[:100]}")
+        supports_ranges, total_size, etag = False, None, None
+
+    if partial.ranges:
+        if partial.matches(total_size, etag) and (supports_ranges or len(partial.ranges) == 1):
+            print(f"[DOWNLOAD] Resuming with {partial.remaining() // 1024} KB left")
+            metrics.DOWNLOAD_RESUMES.inc()
+            if len(partial.ranges) == 1:
+                return _download_single(url, partial, reserve)
+            return _download_ranges(url, partial)
+        print("[DOWNLOAD] Source changed since the last attempt, starting over")
+        partial.reset()
+
+    partial.total_size = total_size
+    partial.etag = etag
+    segments = min(segments, (total_size or 0) // MIN_SEGMENT_BYTES)
+    if not supports_ranges or segments < 2:
+        if supports_ranges is False:
+            metrics.FALLBACKS.inc(source='segmented', target='single')
+        return _download_single(url, partial, reserve)
+
+    _reserve_upto(partial, reserve, total_size)
+
+    # Segments start on hash block boundaries so each one hashes whole blocks
+    segment_size = -(-total_size // segments // HASH_BLOCK_SIZE) * HASH_BLOCK_SIZE
+    for start in range(0, total_size, segment_size):
+        partial.ranges.append([start, min(start + segment_size, total_size) - 1])
+    print(f"[DOWNLOAD] Fetching {total_size // 1024} KB in {len(partial.ranges)} parallel segments")
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        # Reserve the whole file up front so segments can be written at their offsets
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, total_size)
+            except OSError:
+                os.ftruncate(fd, total_size)
+        else:
+            os.ftruncate(fd, total_size)
+    finally:
+        os.close(fd)
+    return _download_ranges(url, partial)
+
+
+def _download_ranges(url, partial):
+    """Fetch every unfinished segment of partial in parallel"""
+    pending = [segment for segment in partial.ranges if segment[0] <= segment[1]]
+    fd = os.open(partial.path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(pending)), thread_name_prefix='segment') as executor:
+            futures = [executor.submit(_download_segment, url, fd, segment, partial.etag, partial.hasher) for segment in pending]
+            downloaded_bytes = 0
+            errors = []
+            for future in futures:
+                try:
+                    downloaded_bytes += future.result()
+                except Exception as e:
+                    errors.append(e)
+    finally:
+        os.close(fd)
+
+    if errors:
+        # An expired URL wins so the caller knows re-resolving it is enough
+        raise next((e for e in errors if isinstance(e, UrlExpiredError)), errors[0])
+    if partial.remaining():
+        raise Exception(f"Download incomplete, {partial.remaining()} bytes missing")
+    return downloaded_bytes
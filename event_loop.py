@@ -0,0 +1,82 @@
+import asyncio
+import atexit
+import queue
+import threading
+
+# One asyncio loop per process, on its own daemon thread. It owns every long-lived
+# async resource (the Playwright browser pool, the aiohttp session of the remote
+# converter) so they are created once and shared by all Flask request threads.
+
+_loop = None
+_lock = threading.Lock()
+_shutdown_callbacks = []
+
+
+def get_loop():
+    """Start the shared loop thread on first use and return its loop"""
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='freefbzone-async', daemon=True)
+            thread.start()
+            _loop = loop
+            atexit.register(_shutdown)
+        return _loop
+
+
+def submit(coroutine):
+    """Schedule a coroutine on the shared loop from any thread and return a concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop())
+
+
+def run(coroutine, timeout=None):
+    """Run a coroutine on the shared loop and wait for its result; it is cancelled if the wait fails"""
+    future = submit(coroutine)
+    try:
+        return future.result(timeout)
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def iterate(async_iterator):
+    """Consume an async iterator on the shared loop and yield its items in the calling thread"""
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in async_iterator:
+                items.put(item)
+        finally:
+            items.put(done)
+
+    future = submit(pump())
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+        future.result()
+    finally:
+        # Stops the remaining work if the consumer goes away early
+        future.cancel()
+
+
+def on_shutdown(coroutine_function):
+    """Register an async cleanup (e.g. closing a session) to run on the loop at interpreter exit"""
+    _shutdown_callbacks.append(coroutine_function)
+
+
+def _shutdown():
+    if _loop is None or not _loop.is_running():
+        return
+    # Resources created last are closed first
+    for coroutine_function in reversed(_shutdown_callbacks):
+        try:
+            asyncio.run_coroutine_threadsafe(coroutine_function(), _loop).result(10)
+        except Exception:
+            pass
+    _loop.call_soon_threadsafe(_loop.stop)
@@ -4,7 +4,6 @@ import re
 import sys
 from urllib.parse import urlparse, parse_qs
 import json
-from profile_automation import download_chromedriver
 
 # Set UTF-8 encoding for Windows console
 if sys.platform.startswith('win'):
@@ -28,6 +27,7 @@ def extract_uploader_with_browser(video_url):
         from selenium.webdriver.chrome.service import Service
         from selenium.webdriver.chrome.options import Options
         from webdriver_manager.chrome import ChromeDriverManager
+        from profile_automation import download_chromedriver
         import time
         import platform
         import os
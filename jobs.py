@@ -0,0 +1,314 @@
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+from scratch import get_scratch_manager
+from admission import OverloadedError, estimate_retry_after
+
+# Worker pool configuration (override through environment variables)
+AUDIO_WORKERS = int(os.getenv('AUDIO_WORKERS', '2'))
+AUDIO_QUEUE_SIZE = int(os.getenv('AUDIO_QUEUE_SIZE', '20'))
+# Finished jobs are forgotten (and their files removed) after this many seconds
+JOB_TTL_SECONDS = int(os.getenv('AUDIO_JOB_TTL', '3600'))
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+
+
+def _keys(cache_key):
+    return list(cache_key) if isinstance(cache_key, tuple) else [cache_key]
+
+
+class QueueFullError(OverloadedError):
+    """Raised when the job queue is at capacity and cannot accept more work"""
+    pass
+
+
+class Job:
+    def __init__(self, video_url, cache_key=None, options=None):
+        self.id = uuid.uuid4().hex
+        self.video_url = video_url
+        # A tuple of keys for multi-output jobs, one per output in order
+        self.cache_key = cache_key
+        # Extra keyword arguments for the pipeline, e.g. audio_format and bitrate
+        self.options = options or {}
+        self.cached = False
+        # Set when this job shares the pipeline of an identical in-flight job
+        self.leader = None
+        self.followers = []
+        self.status = STATUS_QUEUED
+        self.stage = 'queued'
+        self.progress = 0
+        self.result_path = None
+        # Every output of a multi-output job; result_path is the first
+        self.result_paths = []
+        self.error = None
+        # Seconds the client should wait before retrying when a stage rejected the job
+        self.retry_after = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def update(self, stage, progress):
+        self.stage = stage
+        self.progress = progress
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def set_results(self, paths):
+        self.result_paths = list(paths)
+        self.result_path = self.result_paths[0] if self.result_paths else None
+
+    def complete_from_cache(self, paths):
+        self.set_results(paths)
+        self.cached = True
+        self.status = STATUS_COMPLETED
+        self.update('completed', 100)
+        self.finished_at = time.time()
+        self.done.set()
+
+    def follow(self, leader):
+        self.leader = leader
+        self.status = leader.status
+        self.update(leader.stage, leader.progress)
+
+    def finish_from(self, leader):
+        """Copy the outcome of the job whose pipeline this one shared"""
+        self.status = leader.status
+        self.update(leader.stage, leader.progress)
+        self.set_results(leader.result_paths)
+        self.error = leader.error
+        self.retry_after = leader.retry_after
+        self.finished_at = time.time()
+        self.done.set()
+
+    def to_dict(self):
+        # While coalesced, report the live stage of the shared pipeline
+        source = self.leader if self.leader and not self.done.is_set() else self
+        return {
+            'id': self.id,
+            'status': source.status,
+            'cached': self.cached,
+            'coalesced': self.leader is not None,
+            'stage': source.stage,
+            'progress': source.progress,
+            'error': self.error,
+            'retry_after': self.retry_after,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs audio jobs on a fixed pool of worker threads fed by a bounded queue,
+    so long SnapSave + FFmpeg runs never pin a Flask request thread.
+    Each job runs in its own scratch workspace, passed to `process` as `workspace`
+    together with the `cache`.
+    Finished files are moved into `cache` (if given) and cache hits complete immediately.
+    Jobs with the same cache key as a queued or running job are coalesced onto it
+    (single-flight), so a viral video only runs the pipeline once.
+    With `handoff`, `process` is also passed handoff=True and may return a
+    concurrent.futures.Future (e.g. a remote conversion on the shared event loop);
+    the worker then goes back to the queue and the job is finished when it resolves.
+    """
+
+    def __init__(self, process, cache=None, scratch=None, workers=AUDIO_WORKERS, queue_size=AUDIO_QUEUE_SIZE, ttl=JOB_TTL_SECONDS, handoff=False):
+        self.process = process
+        self.cache = cache
+        self.scratch = scratch or get_scratch_manager()
+        self.workers = max(1, workers)
+        self.ttl = ttl
+        self.handoff = handoff
+        self.handed_off = 0
+        # Finishes handed-off jobs (cache moves, cleanup) off the event loop thread that resolves them
+        self.finisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audio-finisher')
+        # Running average of pipeline time, used for Retry-After estimates
+        self.average_job_seconds = 60.0
+        self.jobs = {}
+        self.inflight = {}  # cache key -> job running the pipeline for it
+        self.coalesced = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"audio-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, video_url, cache_key=None, options=None):
+        """Queue a new job and return it. Raises QueueFullError if the queue is at capacity."""
+        self._purge_expired()
+        job = Job(video_url, cache_key, options)
+        with self.lock:
+            self.jobs[job.id] = job
+
+        if self.cache and cache_key:
+            cached_paths = [self.cache.get(key) for key in _keys(cache_key)]
+            if all(cached_paths):
+                print(f"[CACHE] Hit for {cache_key}")
+                metrics.CACHE_REQUESTS.inc(result='hit')
+                job.complete_from_cache(cached_paths)
+                return job
+            metrics.CACHE_REQUESTS.inc(result='miss')
+
+        if cache_key:
+            with self.lock:
+                leader = self.inflight.get(cache_key)
+                if leader:
+                    job.follow(leader)
+                    leader.followers.append(job)
+                    self.coalesced += 1
+                    metrics.JOBS_COALESCED.inc()
+                    print(f"[QUEUE] Job {job.id[:8]} coalesced onto {leader.id[:8]}")
+                    return job
+                self.inflight[cache_key] = job
+
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                self.jobs.pop(job.id, None)
+                if cache_key and self.inflight.get(cache_key) is job:
+                    del self.inflight[cache_key]
+                followers = list(job.followers)
+            error = QueueFullError(
+                "Server is busy, too many audio jobs queued. Please try again later.",
+                estimate_retry_after(self.queue.qsize(), self.average_job_seconds, self.workers)
+            )
+            metrics.STAGE_REJECTIONS.inc(stage='queue')
+            job.status = STATUS_FAILED
+            job.error = str(error)
+            job.retry_after = error.retry_after
+            for follower in followers:
+                follower.finish_from(job)
+            raise error
+        metrics.JOBS_IN_FLIGHT.inc(state='queued')
+        print(f"[QUEUE] Job {job.id[:8]} queued ({self.queue.qsize()} waiting)")
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            metrics.JOBS_IN_FLIGHT.dec(state='queued')
+            try:
+                self._run(job)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, job):
+        job.status = STATUS_RUNNING
+        job.update('starting', 5)
+        metrics.JOBS_IN_FLIGHT.inc(state='running')
+        start = time.perf_counter()
+        workspace = None
+        try:
+            workspace = self.scratch.open_workspace()
+            options = dict(job.options, handoff=True) if self.handoff else job.options
+            result = self.process(job.video_url, progress=job.update, workspace=workspace, cache=self.cache, **options)
+        except Exception as e:
+            self._finish(job, workspace, start, error=e)
+            return
+        if isinstance(result, Future):
+            print(f"[QUEUE] Job {job.id[:8]} handed off, worker released")
+            with self.lock:
+                self.handed_off += 1
+            result.add_done_callback(lambda future: self.finisher.submit(self._finish, job, workspace, start, future))
+            return
+        self._finish(job, workspace, start, result)
+
+    def _finish(self, job, workspace, start, result=None, error=None):
+        """Store the outcome of a job's pipeline (a path, a list of paths, or a Future of either) and clean up"""
+        try:
+            if isinstance(result, Future):
+                with self.lock:
+                    self.handed_off -= 1
+                result = result.result()
+            if error is not None:
+                raise error
+            # Multi-output pipelines return one path per output
+            job.set_results(result if isinstance(result, (list, tuple)) else [result])
+            if not job.result_paths or not all(path and os.path.exists(path) for path in job.result_paths):
+                raise Exception("Failed to process audio")
+            self._store_result(job, workspace)
+            job.status = STATUS_COMPLETED
+            job.update('completed', 100)
+            elapsed = time.perf_counter() - start
+            metrics.JOB_SECONDS.observe(elapsed)
+            self.average_job_seconds = 0.8 * self.average_job_seconds + 0.2 * elapsed
+        except Exception as e:
+            print(f"[ERROR] Job {job.id[:8]} failed: {str(e)[:200]}")
+            job.status = STATUS_FAILED
+            job.error = str(e)
+            job.stage = 'failed'
+            if isinstance(e, OverloadedError):
+                job.retry_after = e.retry_after
+        finally:
+            if workspace:
+                self.scratch.close_workspace(workspace)
+            metrics.JOBS_IN_FLIGHT.dec(state='running')
+            metrics.JOBS_TOTAL.inc(outcome=job.status)
+            job.finished_at = time.time()
+            with self.lock:
+                if job.cache_key and self.inflight.get(job.cache_key) is job:
+                    del self.inflight[job.cache_key]
+                followers = list(job.followers)
+            job.done.set()
+            for follower in followers:
+                follower.finish_from(job)
+
+    def stats(self):
+        with self.lock:
+            running = sum(1 for job in self.inflight.values() if job.status == STATUS_RUNNING)
+            return {
+                'workers': self.workers,
+                'queued': self.queue.qsize(),
+                'running': running,
+                'handed_off': self.handed_off,
+                'coalesced': self.coalesced,
+            }
+
+    def _store_result(self, job, workspace):
+        """Move the results out of the job's workspace, into the cache when possible"""
+        keys = _keys(job.cache_key) if self.cache and job.cache_key else [None] * len(job.result_paths)
+        stored = []
+        for key, path in zip(keys, job.result_paths):
+            cached_path = None
+            if key:
+                try:
+                    cached_path = self.cache.put(key, path, move=True)
+                    if cached_path:
+                        # Lets other URLs for the same bytes reuse this output (see audio.reuse_source_outputs)
+                        self.cache.record_source(workspace.source_hash, key, cached_path)
+                except Exception as e:
+                    print(f"[CACHE] Warning: could not cache result: {str(e)[:100]}")
+            stored.append(cached_path or workspace.keep(path))
+        job.set_results(stored)
+        if self.cache and len(keys) > 1 and all(key for key in keys):
+            # Outputs of one decode are linked so each artifact can point at the others
+            self.cache.relate(keys)
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job.finished_at and job.finished_at < cutoff]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            for path in job.result_paths:
+                # Cached files outlive their jobs, the cache evicts them itself
+                if self.cache and self.cache.contains_path(path):
+                    continue
+                self.scratch.discard(path)
+        # Also catches results kept by other processes or jobs this process no longer knows about
+        self.scratch.sweep_results()
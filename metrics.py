@@ -0,0 +1,210 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal Prometheus text-format metrics, so /metrics works without extra dependencies
+
+TIME_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+
+_registry = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {} if labelnames else {(): 0}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {} if labelnames else {(): 0}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.series = {}  # label key -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self.lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self.series.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = key + (('le', _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(labels)} {bucket_count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+def render():
+    """Render every registered metric in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+# Pipeline stage metrics
+SNAPSAVE_RESOLVE_SECONDS = Histogram(
+    'freefbzone_snapsave_resolve_seconds', 'Time to resolve a download URL through SnapSave', ['outcome', 'method'])
+CDN_DOWNLOAD_SECONDS = Histogram(
+    'freefbzone_cdn_download_seconds', 'Time to download the source video from the CDN')
+CDN_DOWNLOAD_THROUGHPUT = Histogram(
+    'freefbzone_cdn_download_bytes_per_second', 'CDN download throughput', buckets=THROUGHPUT_BUCKETS)
+CDN_DOWNLOAD_BYTES = Counter(
+    'freefbzone_cdn_download_bytes_total', 'Bytes downloaded from the CDN')
+DOWNLOAD_SEGMENT_RETRIES = Counter(
+    'freefbzone_download_segment_retries_total', 'Retried byte-range segments of segmented CDN downloads')
+DOWNLOAD_RESUMES = Counter(
+    'freefbzone_download_resumes_total', 'CDN downloads resumed from a partial file after a failure')
+DOWNLOAD_URL_REFRESHES = Counter(
+    'freefbzone_download_url_refreshes_total', 'Signed CDN URLs re-resolved through SnapSave after expiring mid-download')
+SNAPSAVE_PAGE_SECONDS = Histogram(
+    'freefbzone_snapsave_page_seconds', 'Time the SnapSave page takes to show the download links', ['blocking'])
+SNAPSAVE_BLOCKED_REQUESTS = Counter(
+    'freefbzone_snapsave_blocked_requests_total', 'Requests aborted on the SnapSave page', ['type'])
+SNAPSAVE_BLOCKED_BYTES = Counter(
+    'freefbzone_snapsave_blocked_bytes_total', 'Estimated bytes not downloaded because of request blocking')
+FFMPEG_TRANSCODE_SECONDS = Histogram(
+    'freefbzone_ffmpeg_transcode_seconds', 'Time spent in local FFmpeg conversion', ['outcome', 'mode'])
+REMOTE_CONVERT_SECONDS = Histogram(
+    'freefbzone_remote_convert_seconds', 'Time spent in the videotomp3 conversion service', ['outcome'])
+FALLBACKS = Counter(
+    'freefbzone_fallbacks_total', 'Times a stage fell back to a slower path', ['source', 'target'])
+
+# Job metrics
+JOBS_IN_FLIGHT = Gauge(
+    'freefbzone_jobs_in_flight', 'Audio jobs currently queued or running', ['state'])
+JOBS_TOTAL = Counter(
+    'freefbzone_jobs_total', 'Finished audio jobs', ['outcome'])
+JOBS_COALESCED = Counter(
+    'freefbzone_jobs_coalesced_total', 'Job submissions that shared an identical in-flight pipeline')
+JOB_SECONDS = Histogram(
+    'freefbzone_job_seconds', 'End-to-end audio pipeline time per job')
+CACHE_REQUESTS = Counter(
+    'freefbzone_cache_requests_total', 'Audio cache lookups', ['result'])
+URL_CACHE_REQUESTS = Counter(
+    'freefbzone_url_cache_requests_total', 'Lookups of already resolved CDN download URLs', ['result'])
+SOURCE_DEDUP_HITS = Counter(
+    'freefbzone_source_dedup_hits_total', 'Jobs that reused outputs of an identical source video downloaded through another URL')
+STAGE_ACTIVE = Gauge(
+    'freefbzone_stage_active', 'Pipeline stage slots currently in use', ['stage'])
+STAGE_REJECTIONS = Counter(
+    'freefbzone_stage_rejections_total', 'Requests rejected with 429 because a stage was saturated', ['stage'])
+BROWSERS_RUNNING = Gauge(
+    'freefbzone_browsers_running', 'Warm browsers in the SnapSave browser pool')
+BROWSER_LAUNCHES = Counter(
+    'freefbzone_browser_launches_total', 'Browsers launched by the SnapSave browser pool')
+BROWSER_RECYCLES = Counter(
+    'freefbzone_browser_recycles_total', 'Pooled browsers closed and replaced', ['reason'])
+STREAMS_IN_FLIGHT = Gauge(
+    'freefbzone_streams_in_flight', 'Streaming audio responses currently being produced')
+
+for state in ('queued', 'running'):
+    JOBS_IN_FLIGHT.set(0, state=state)
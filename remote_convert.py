@@ -0,0 +1,142 @@
+import asyncio
+import os
+import random
+import time
+
+import aiohttp
+
+import event_loop
+import metrics
+
+# Remote conversion service configuration (override through environment variables)
+REMOTE_CONVERT_URL = os.getenv('AUDIO_REMOTE_CONVERT_URL', 'https://videotomp3.onrender.com').rstrip('/')
+REMOTE_CONVERT_TIMEOUT = int(os.getenv('AUDIO_REMOTE_CONVERT_TIMEOUT', '300'))
+REMOTE_MAX_CONNECTIONS = int(os.getenv('AUDIO_REMOTE_MAX_CONNECTIONS', '32'))
+# Status polls start fast and back off towards the slow interval for long conversions
+POLL_INITIAL_SECONDS = 0.5
+POLL_MAX_SECONDS = 10.0
+POLL_BACKOFF = 1.5
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+_session = None
+
+
+async def _close_session():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+event_loop.on_shutdown(_close_session)
+
+
+def _get_session():
+    # Created lazily on the shared loop thread (see event_loop.py), used by all jobs so connections are pooled
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=REMOTE_MAX_CONNECTIONS, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def _file_chunks(path):
+    """Read the upload in chunks off the loop thread so large videos are never held in memory"""
+    loop = asyncio.get_running_loop()
+    with open(path, 'rb') as source:
+        while True:
+            chunk = await loop.run_in_executor(None, source.read, UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def _upload(session, video_file_path):
+    form = aiohttp.FormData()
+    form.add_field('file', _file_chunks(video_file_path), filename='video.mp4', content_type='video/mp4')
+    async with session.post(f"{REMOTE_CONVERT_URL}/upload", data=form, timeout=aiohttp.ClientTimeout(total=180)) as response:
+        if response.status != 200:
+            raise Exception(f"Upload failed with status {response.status}: {(await response.text())[:200]}")
+        try:
+            upload_data = await response.json(content_type=None)
+        except Exception as e:
+            raise Exception(f"Failed to parse upload response: {str(e)}")
+    job_id = upload_data.get('job_id')
+    if not job_id:
+        raise Exception("No job_id received from upload response")
+    return job_id
+
+
+async def _wait_until_done(session, job_id):
+    status_url = f"{REMOTE_CONVERT_URL}/status/{job_id}"
+    deadline = time.monotonic() + REMOTE_CONVERT_TIMEOUT
+    delay = POLL_INITIAL_SECONDS
+    next_report = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(status_url, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                if response.status == 200:
+                    status_data = await response.json(content_type=None)
+                    status = status_data.get('status', 'unknown')
+                    if status == 'completed':
+                        return
+                    if status == 'failed':
+                        raise Exception(f"Conversion failed: {status_data.get('error', 'Unknown conversion error')}")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass  # Transient; the next poll retries
+
+        if time.monotonic() >= next_report:
+            print(f"[REMOTE] Job {job_id} still converting...")
+            next_report += 30
+        # Jitter keeps concurrent jobs from polling in lockstep
+        await asyncio.sleep(min(delay, max(0, deadline - time.monotonic())) * random.uniform(0.8, 1.2))
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_SECONDS)
+    raise Exception("Conversion timeout - took longer than expected")
+
+
+async def _download(session, job_id, audio_file_path, reserve=None):
+    async with session.get(f"{REMOTE_CONVERT_URL}/download/{job_id}", timeout=aiohttp.ClientTimeout(total=120)) as response:
+        if response.status != 200:
+            raise Exception(f"Download failed with status {response.status}")
+        # Disk writes and quota reservations (which take the scratch lock) run off the loop thread
+        loop = asyncio.get_running_loop()
+        audio_file = await loop.run_in_executor(None, open, audio_file_path, 'wb')
+
+        def write(chunk):
+            if reserve:
+                reserve(len(chunk))
+            audio_file.write(chunk)
+
+        try:
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                await loop.run_in_executor(None, write, chunk)
+        finally:
+            await loop.run_in_executor(None, audio_file.close)
+
+
+async def convert_async(video_file_path, audio_file_path, reserve=None):
+    """Upload a video to the conversion service, poll until it is done and save the MP3"""
+    session = _get_session()
+    start = time.perf_counter()
+    try:
+        job_id = await _upload(session, video_file_path)
+        print(f"[REMOTE] Upload successful, job {job_id}")
+        await _wait_until_done(session, job_id)
+        await _download(session, job_id, audio_file_path, reserve)
+    except Exception:
+        metrics.REMOTE_CONVERT_SECONDS.observe(time.perf_counter() - start, outcome='failure')
+        raise
+    metrics.REMOTE_CONVERT_SECONDS.observe(time.perf_counter() - start, outcome='success')
+    return audio_file_path
+
+
+# Upper bound for a whole conversion: upload, REMOTE_CONVERT_TIMEOUT of polling, then the download
+CONVERT_DEADLINE_SECONDS = REMOTE_CONVERT_TIMEOUT + 360
+
+
+def submit(video_file_path, audio_file_path, reserve=None):
+    """Schedule a conversion on the shared loop and return a concurrent.futures.Future"""
+    return event_loop.submit(asyncio.wait_for(convert_async(video_file_path, audio_file_path, reserve), CONVERT_DEADLINE_SECONDS))
+
+
+def convert(video_file_path, audio_file_path, reserve=None):
+    """Blocking wrapper for the synchronous pipeline"""
+    return event_loop.run(convert_async(video_file_path, audio_file_path, reserve), timeout=CONVERT_DEADLINE_SECONDS)
@@ -0,0 +1,234 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from admission import OverloadedError
+
+
+def _default_root():
+    # AUDIO_SCRATCH_TMPFS=1 keeps intermediate files in RAM when /dev/shm is available
+    if os.getenv('AUDIO_SCRATCH_TMPFS') == '1' and os.path.isdir('/dev/shm'):
+        return '/dev/shm/freefbzone_scratch'
+    return os.path.join(tempfile.gettempdir(), 'freefbzone_scratch')
+
+
+# Scratch space configuration (override through environment variables)
+SCRATCH_DIR = os.getenv('AUDIO_SCRATCH_DIR') or _default_root()
+SCRATCH_JOB_QUOTA = int(os.getenv('AUDIO_SCRATCH_JOB_QUOTA', str(1024 * 1024 * 1024)))
+SCRATCH_TOTAL_QUOTA = int(os.getenv('AUDIO_SCRATCH_TOTAL_QUOTA', str(4 * 1024 * 1024 * 1024)))
+# Directories from processes we can't check (e.g. on Windows) are swept after this age
+SCRATCH_STALE_SECONDS = 24 * 3600
+# Results kept outside the cache are removed after the same TTL as finished jobs
+SCRATCH_RESULT_TTL = int(os.getenv('AUDIO_JOB_TTL', '3600'))
+
+
+class QuotaExceededError(Exception):
+    """Raised when a job would use more scratch space than its own quota allows"""
+    pass
+
+
+class ScratchFullError(OverloadedError):
+    """Raised when the shared scratch space is full; the job can be retried later"""
+    pass
+
+
+class Workspace:
+    """A private scratch directory for one job, with a byte quota"""
+
+    def __init__(self, manager, path, quota):
+        self.manager = manager
+        self.path = path
+        self.quota = quota
+        self.reserved = 0
+        # Content hash of the downloaded source video, once known
+        self.source_hash = None
+
+    def file(self, name):
+        """Path of a file inside this workspace"""
+        return os.path.join(self.path, name)
+
+    def reserve(self, nbytes):
+        """Account for nbytes about to be written, raising if a quota would be exceeded"""
+        self.manager._reserve(self, nbytes)
+
+    def sync(self):
+        """Re-measure the files on disk (e.g. after FFmpeg wrote its output) and enforce the quota"""
+        used = 0
+        for name in os.listdir(self.path):
+            try:
+                used += os.path.getsize(os.path.join(self.path, name))
+            except OSError:
+                pass
+        if used > self.reserved:
+            self.reserve(used - self.reserved)
+
+    def release(self, path):
+        """Delete a file early and give its space back"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.manager._release(self, min(size, self.reserved))
+
+    def keep(self, path):
+        """Move a result out of the workspace so it survives cleanup (see ScratchManager.sweep_results)"""
+        return self.manager._keep(self, path)
+
+
+class ScratchManager:
+    """
+    Hands out one directory per job under a shared root (optionally on tmpfs),
+    enforces per-job and global byte quotas, and removes directories when the
+    job ends, at interpreter exit, and on startup for processes that died.
+    """
+
+    def __init__(self, root=SCRATCH_DIR, job_quota=SCRATCH_JOB_QUOTA, total_quota=SCRATCH_TOTAL_QUOTA, result_ttl=SCRATCH_RESULT_TTL):
+        self.root = root
+        self.job_quota = job_quota
+        self.total_quota = total_quota
+        self.result_ttl = result_ttl
+        self.lock = threading.Lock()
+        self.reserved = 0
+        self.active = {}
+        # Results kept after their workspace was removed (uncached outputs), path -> size;
+        # they stay in the global reservation until swept
+        self.results_directory = os.path.join(self.root, 'results')
+        self.results = {}
+        os.makedirs(self.results_directory, exist_ok=True)
+        self.sweep_stale()
+        atexit.register(self.cleanup_all)
+
+    def sweep_stale(self):
+        """Remove directories left behind by processes that are no longer running"""
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            parts = name.split('-')
+            if len(parts) < 3 or parts[0] != 'job' or not parts[1].isdigit():
+                continue
+            pid = int(parts[1])
+            if pid == os.getpid() and path not in self.active:
+                stale = True  # A previous process that had our PID
+            elif os.name == 'posix':
+                stale = not _pid_alive(pid)
+            else:
+                stale = time.time() - os.path.getmtime(path) > SCRATCH_STALE_SECONDS
+            if stale:
+                shutil.rmtree(path, ignore_errors=True)
+                print(f"[SCRATCH] Removed stale workspace {name}")
+        self.sweep_results()
+
+    def sweep_results(self):
+        """Remove kept results older than the result TTL, including those left by earlier processes"""
+        cutoff = time.time() - self.result_ttl
+        for name in os.listdir(self.results_directory):
+            path = os.path.join(self.results_directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_mtime < cutoff:
+                self.discard(path)
+            else:
+                with self.lock:
+                    if path not in self.results:
+                        # Still fresh from an earlier process: count it until it expires
+                        self.results[path] = stat.st_size
+                        self.reserved += stat.st_size
+
+    def discard(self, path):
+        """Delete a kept result and give its space back"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        with self.lock:
+            self.reserved -= self.results.pop(path, 0)
+
+    @contextmanager
+    def workspace(self, quota=None):
+        """Create a private directory for one job and always remove it afterwards"""
+        workspace = self.open_workspace(quota)
+        try:
+            yield workspace
+        finally:
+            self.close_workspace(workspace)
+
+    def open_workspace(self, quota=None):
+        """Create a private directory for a job that outlives the calling thread; see close_workspace"""
+        path = os.path.join(self.root, f"job-{os.getpid()}-{uuid.uuid4().hex[:12]}")
+        os.makedirs(path)
+        workspace = Workspace(self, path, quota or self.job_quota)
+        with self.lock:
+            self.active[path] = workspace
+        return workspace
+
+    def close_workspace(self, workspace):
+        """Remove a workspace and give back its space"""
+        self._cleanup(workspace)
+
+    def _reserve(self, workspace, nbytes):
+        with self.lock:
+            if workspace.reserved + nbytes > workspace.quota:
+                raise QuotaExceededError(f"Video is too large: job scratch quota of {workspace.quota // (1024 * 1024)} MB exceeded")
+            if self.reserved + nbytes > self.total_quota:
+                raise ScratchFullError("Server is busy (scratch space full). Please try again later.", 30)
+            workspace.reserved += nbytes
+            self.reserved += nbytes
+
+    def _release(self, workspace, nbytes):
+        with self.lock:
+            workspace.reserved -= nbytes
+            self.reserved -= nbytes
+
+    def _keep(self, workspace, path):
+        fd, kept_path = tempfile.mkstemp(prefix='result-', suffix=os.path.splitext(path)[1], dir=self.results_directory)
+        os.close(fd)
+        shutil.move(path, kept_path)
+        size = os.path.getsize(kept_path)
+        with self.lock:
+            # The bytes were already reserved by the workspace; move them to the kept results
+            transferred = min(size, workspace.reserved)
+            workspace.reserved -= transferred
+            self.reserved += size - transferred
+            self.results[kept_path] = size
+        return kept_path
+
+    def _cleanup(self, workspace):
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        with self.lock:
+            self.active.pop(workspace.path, None)
+            self.reserved -= workspace.reserved
+            workspace.reserved = 0
+
+    def cleanup_all(self):
+        for workspace in list(self.active.values()):
+            self._cleanup(workspace)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_scratch_manager():
+    """Process-wide scratch manager, created on first use"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ScratchManager()
+        return _manager
@@ -6,6 +6,29 @@ const { scrapeFacebookVideo } = require('./scraper.js');
 const { scrapeFacebookPhoto } = require('./photo_scraper.js');
 const { exec } = require('child_process');
 const fs = require('fs');
+const os = require('os');
+
+// Finished audio artifacts written by audio.py (see audio_cache.py)
+const AUDIO_CACHE_DIR = process.env.AUDIO_CACHE_DIR || path.join(os.tmpdir(), 'freefbzone_cache');
+const ARTIFACT_ID_PATTERN = /^[0-9a-f]{64}\.[a-z0-9]{1,5}$/;
+const ARTIFACT_MAX_AGE = parseInt(process.env.AUDIO_ARTIFACT_MAX_AGE || '86400', 10);
+
+// Serve a cached artifact with Range, ETag and If-None-Match support (handled by res.sendFile)
+function sendArtifact(res, artifactId) {
+    res.setHeader('X-Artifact-Id', artifactId);
+    res.setHeader('Content-Disposition', 'attachment; filename="freefbzone_audio.mp3"');
+    res.sendFile(path.join(AUDIO_CACHE_DIR, artifactId), {
+        maxAge: ARTIFACT_MAX_AGE * 1000,
+        acceptRanges: true,
+        etag: true,
+        lastModified: true,
+        headers: { 'Content-Type': 'audio/mpeg' }
+    }, (err) => {
+        if (err && !res.headersSent) {
+            res.status(err.status || 500).json({ error: 'Failed to send audio file' });
+        }
+    });
+}
 
 // Optional Facebook Graph API token (set as environment variable)
 const FACEBOOK_TOKEN = process.env.FACEBOOK_TOKEN || '';
@@ -358,9 +381,16 @@ app.post('/download-audio', async (req, res) => {
             
             // Check if the script indicates success and extract the audio file path
             const match = stdout.match(/Audio file ready: (.*)/);
+            const artifactMatch = stdout.match(/Artifact ID: (.*)/);
             if (match && match[1]) {
                 const audioFilePath = match[1].trim();
                 
+                if (artifactMatch && ARTIFACT_ID_PATTERN.test(artifactMatch[1].trim())) {
+                    // Cached artifacts are kept so dropped downloads can resume via /artifacts/:id
+                    console.log(`Audio artifact ready: ${audioFilePath}`);
+                    return sendArtifact(res, artifactMatch[1].trim());
+                }
+                
                 if (fs.existsSync(audioFilePath)) {
                     console.log(`Audio file found: ${audioFilePath}`);
                     
@@ -405,6 +435,15 @@ app.post('/download-audio', async (req, res) => {
     }
 });
 
+// Download a finished audio artifact by its stable ID (resumable, cacheable)
+app.get('/artifacts/:id', (req, res) => {
+    const artifactId = req.params.id;
+    if (!ARTIFACT_ID_PATTERN.test(artifactId) || !fs.existsSync(path.join(AUDIO_CACHE_DIR, artifactId))) {
+        return res.status(404).json({ error: 'Artifact not found' });
+    }
+    sendArtifact(res, artifactId);
+});
+
 app.listen(port, () => {
     console.log(`Server is running! Open http://localhost:${port} in your browser.`);
 });
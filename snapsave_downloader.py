@@ -2,8 +2,22 @@ import asyncio
 import os
 import sys
 from urllib.parse import urlparse, unquote
-from playwright.async_api import async_playwright
 import argparse
+import base64
+import json
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+import requests
+from bs4 import BeautifulSoup
+
+import metrics
+import url_cache
+from admission import OverloadedError
 
 # Fix Windows console encoding issues
 if sys.platform == "win32":
@@ -19,105 +33,617 @@ if sys.platform == "win32":
     except:
         pass  # If encoding setup fails, continue with default encoding
 
-async def download_facebook_video_snapsave(url):
+# JavaScript that collects every row of SnapSave's download table
+DOWNLOAD_TABLE_ROWS_JS = """
+() => Array.from(document.querySelectorAll('#download-section table tbody tr')).map(row => {
+    const cells = row.querySelectorAll('td');
+    const link = row.querySelector('a[href]');
+    return {
+        quality: cells.length ? cells[0].innerText.trim() : '',
+        url: link ? link.href : null
+    };
+})
+"""
+
+# Size probes of the download rows (override through environment variables)
+PROBE_SIZES = os.getenv('AUDIO_SNAPSAVE_PROBE_SIZES', '1') != '0'
+PROBE_TIMEOUT = int(os.getenv('AUDIO_SNAPSAVE_PROBE_TIMEOUT', '5'))
+
+def parse_resolution(quality):
+    """Return the vertical resolution from a label like '720p (HD)', or None"""
+    match = re.search(r'(\d{3,4})p', quality or '')
+    return int(match.group(1)) if match else None
+
+def _vencode_tag(option):
+    """Encode tag from the fbcdn `efg` parameter (base64 JSON), lowercased, or ''"""
+    efg = parse_qs(urlparse(option.get('url') or '').query).get('efg', [None])[0]
+    if not efg:
+        return ''
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(unquote(efg) + '=' * (-len(efg) % 4)))
+        return str(decoded.get('vencode_tag', '')).lower()
+    except Exception:
+        return ''
+
+def is_audio_only(option):
     """
-    Download a Facebook video using snapsave.app
+    Detect audio-only renditions, either from SnapSave's label or from the
+    fbcdn `efg` parameter (base64 JSON whose encode tag names DASH audio streams).
     """
-    print(f"[PHONE] Processing with SnapSave: {url[:50]}...")
+    if 'audio' in (option.get('quality') or '').lower():
+        return True
+    return 'audio' in _vencode_tag(option)
+
+def has_audio_track(option):
+    """False for renditions known to be silent: DASH video streams and rows labelled without audio"""
+    if is_audio_only(option):
+        return True
+    quality = (option.get('quality') or '').lower()
+    if 'no audio' in quality or 'without audio' in quality or 'mute' in quality:
+        return False
+    # DASH streams are split into video-only and audio-only files; progressive ones carry both
+    return 'dash' not in _vencode_tag(option)
+
+def select_download_option(options, prefer='video'):
+    """
+    Pick a download row, skipping rows without an audio track whenever another row has one.
+    Audio jobs take the smallest rendition, since the video track is thrown away anyway:
+    audio-only first, then the smallest probed size, then the lowest resolution.
+    Video downloads take the best: highest resolution, then the largest file.
+    Ties keep SnapSave's order, which lists the best row first.
+    """
+    with_url = [option for option in options if (option.get('url') or '').startswith('http')]
+    usable = [option for option in with_url if has_audio_track(option)] or with_url
+    if not usable:
+        return None
+    order = {id(option): index for index, option in enumerate(usable)}
+    if prefer == 'audio':
+        audio_only = [option for option in usable if is_audio_only(option)]
+        if audio_only:
+            return audio_only[0]
+        return min(usable, key=lambda option: (
+            option.get('size') is None,
+            option.get('size') or 0,
+            parse_resolution(option.get('quality')) or float('inf'),
+            order[id(option)]
+        ))
+    return max(usable, key=lambda option: (
+        parse_resolution(option.get('quality')) or 0,
+        option.get('size') or 0,
+        -order[id(option)]
+    ))
+
+def probe_option_sizes(options):
+    """Fill in each row's `size` from parallel HEAD requests (None where the CDN won't say)"""
+    from downloader import content_length
+    with_url = [option for option in options if (option.get('url') or '').startswith('http')]
+    if not with_url:
+        return options
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(len(with_url), 8)) as executor:
+        sizes = list(executor.map(lambda option: content_length(option['url'], timeout=PROBE_TIMEOUT), with_url))
+    for option, size in zip(with_url, sizes):
+        option['size'] = size
+    known = [f"{option.get('quality') or '?'}={size // 1024} KB" for option, size in zip(with_url, sizes) if size]
+    print(f"[SIZE] Probed {len(with_url)} renditions in {time.perf_counter() - start:.2f}s ({', '.join(known) or 'no sizes'})")
+    return options
+
+def choose_download_option(options, prefer='video', probe_sizes=None):
+    """
+    Annotate every row with its resolution, audio flags and (when probing is on) size,
+    so callers get the full list, and return the row select_download_option picks.
+    """
+    if probe_sizes is None:
+        probe_sizes = PROBE_SIZES
+    for option in options:
+        option['resolution'] = parse_resolution(option.get('quality'))
+        option['audio_only'] = is_audio_only(option)
+        option['has_audio'] = has_audio_track(option)
+        option.setdefault('size', None)
+    if probe_sizes and len(options) > 1:
+        probe_option_sizes(options)
+    return select_download_option(options, prefer)
+
+def _env_list(name, default):
+    return [item.strip().lower() for item in os.getenv(name, default).split(',') if item.strip()]
+
+# Request blocking on the SnapSave page (override through environment variables)
+BLOCK_RESOURCES = os.getenv('AUDIO_SNAPSAVE_BLOCK', '1') != '0'
+BLOCKED_RESOURCE_TYPES = _env_list('AUDIO_SNAPSAVE_BLOCKED_TYPES', 'image,media,font')
+BLOCKED_DOMAINS = _env_list(
+    'AUDIO_SNAPSAVE_BLOCKED_DOMAINS',
+    'doubleclick.net,googlesyndication.com,googleadservices.com,adservice.google.com,'
+    'googletagmanager.com,google-analytics.com,googletagservices.com,facebook.net,'
+    'hotjar.com,clarity.ms,adsterra.com,popads.net,propellerads.com,amazon-adsystem.com,'
+    'taboola.com,outbrain.com,criteo.com,scorecardresearch.com,quantserve.com,yandex.ru'
+)
+# Share of runs that load everything, to keep a baseline for the time blocking saves.
+# Off by default: sampled runs are real user lookups made slower for a metric
+UNBLOCKED_SAMPLE_RATE = float(os.getenv('AUDIO_SNAPSAVE_UNBLOCKED_SAMPLE', '0'))
+# Hosts that are never blocked, whatever the resource type
+ALLOWED_DOMAINS = _env_list('AUDIO_SNAPSAVE_ALLOWED_DOMAINS', '')
 
-    async with async_playwright() as p:
-        browser = None
-        page = None
-        context = None
+# Typical transfer sizes for estimating the bytes saved, refined from responses that do load
+_typical_bytes = {
+    'image': 30 * 1024, 'media': 500 * 1024, 'font': 40 * 1024, 'script': 60 * 1024,
+    'stylesheet': 20 * 1024, 'xhr': 4 * 1024, 'fetch': 4 * 1024, 'other': 10 * 1024,
+}
+# Running average page time with blocking turned off, the baseline for the time saved
+_unblocked_seconds = {'runs': 0, 'mean': None}
+
+def _host_matches(host, domains):
+    return any(host == domain or host.endswith('.' + domain) for domain in domains)
+
+class ResourceBlocker:
+    """
+    Aborts requests the SnapSave page does not need to show its download links:
+    images, media and fonts, plus ad and analytics hosts. The page document itself
+    and anything on ALLOWED_DOMAINS always load. Counts what was blocked per run.
+    """
+
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = BLOCK_RESOURCES and random.random() >= UNBLOCKED_SAMPLE_RATE
+        self.enabled = enabled
+        self.blocked = {}  # resource type -> requests aborted
+        self.estimated_bytes = 0
+        self.loaded_bytes = 0
+        self.started = time.perf_counter()
+
+    def block_reason(self, request):
+        host = (urlparse(request.url).hostname or '').lower()
+        if request.resource_type == 'document' or _host_matches(host, ALLOWED_DOMAINS):
+            return None
+        if _host_matches(host, BLOCKED_DOMAINS):
+            return 'domain'
+        if request.resource_type in BLOCKED_RESOURCE_TYPES:
+            return 'type'
+        return None
+
+    async def attach(self, context):
+        context.on('response', self._on_response)
+        if self.enabled:
+            await context.route('**/*', self._handle)
+
+    async def _handle(self, route):
+        request = route.request
+        if not self.block_reason(request):
+            await route.continue_()
+            return
+        resource_type = request.resource_type
+        self.blocked[resource_type] = self.blocked.get(resource_type, 0) + 1
+        self.estimated_bytes += _typical_bytes.get(resource_type, _typical_bytes['other'])
         try:
-            # Launch browser using system Chrome instead of Playwright's Chromium
-            browser = await p.chromium.launch(
-                headless=True,
-                executable_path='/usr/bin/google-chrome'
-            )
-            context = await browser.new_context(
-                viewport={"width": 1280, "height": 720},
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
-            )
-            page = await context.new_page()
+            await route.abort('blockedbyclient')
+        except Exception:
+            pass  # The page may already be closing
 
-            # Open SnapSave
-            await page.goto("https://snapsave.app/", timeout=90000)
-            print("[WEB] Connected to SnapSave")
+    def _on_response(self, response):
+        try:
+            size = int(response.headers.get('content-length', ''))
+        except ValueError:
+            return
+        self.loaded_bytes += size
+        resource_type = response.request.resource_type
+        # Exponential moving average so the estimates follow what SnapSave actually serves
+        previous = _typical_bytes.get(resource_type)
+        _typical_bytes[resource_type] = size if previous is None else int(previous * 0.9 + size * 0.1)
 
-            # Fill the Facebook video URL
-            input_selector = "#url"
-            await page.wait_for_selector(input_selector, timeout=60000)
-            await page.fill(input_selector, url)
-            print("[SUBMIT] URL submitted")
-            
-            # Press 'Enter' key to submit the form
-            await page.keyboard.press('Enter')
-            
-            # Instead of a fixed sleep, wait for the download section to be fully visible and stable.
-            # This makes the script more resilient to varying page load times.
-            await page.wait_for_selector("#download-section", timeout=90000, state='visible')
-            print("[WAIT] Processing video...")
-
-            # Now, click the specific download button and capture the download
-            download_button_selector_after_enter = "#download-section > section > div > div.download-link > div:nth-child(2) > div > table > tbody > tr:nth-child(1) > td:nth-child(3) > a"
-            await page.wait_for_selector(download_button_selector_after_enter, timeout=30000, state='visible')
-            
-            print("[LINK] Extracting download link...")
-            
-            # Extract the download URL directly from the button or by expecting a download event
-            let_download_url = None
+    def finish(self):
+        """Record the savings of a successful run and return them for the result dict"""
+        seconds = time.perf_counter() - self.started
+        blocked_requests = sum(self.blocked.values())
+        stats = {
+            'enabled': self.enabled,
+            'blocked_requests': blocked_requests,
+            'blocked_by_type': dict(self.blocked),
+            'estimated_bytes_saved': self.estimated_bytes,
+            'loaded_bytes': self.loaded_bytes,
+            'page_seconds': round(seconds, 2),
+            'estimated_seconds_saved': None,
+        }
+        metrics.SNAPSAVE_PAGE_SECONDS.observe(seconds, blocking='on' if self.enabled else 'off')
+        if not self.enabled:
+            runs = _unblocked_seconds['runs'] + 1
+            mean = _unblocked_seconds['mean'] or 0
+            _unblocked_seconds.update(runs=runs, mean=mean + (seconds - mean) / runs)
+            return stats
+        for resource_type, count in self.blocked.items():
+            metrics.SNAPSAVE_BLOCKED_REQUESTS.inc(count, type=resource_type)
+        metrics.SNAPSAVE_BLOCKED_BYTES.inc(self.estimated_bytes)
+        if _unblocked_seconds['mean'] is not None:
+            stats['estimated_seconds_saved'] = round(_unblocked_seconds['mean'] - seconds, 2)
+        saved = f", ~{stats['estimated_seconds_saved']}s saved" if stats['estimated_seconds_saved'] is not None else ''
+        print(f"[BLOCK] Blocked {blocked_requests} requests (~{self.estimated_bytes // 1024} KB{saved}), page done in {seconds:.1f}s")
+        return stats
+
+# Options for every SnapSave browser context
+CONTEXT_OPTIONS = {
+    "viewport": {"width": 1280, "height": 720},
+    "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
+}
+
+async def resolve_in_context(context, url, prefer='video'):
+    """Drive the SnapSave page inside an existing browser context and return the result dict"""
+    blocker = ResourceBlocker()
+    await blocker.attach(context)
+    page = await context.new_page()
+    try:
+        # Open SnapSave
+        await page.goto(SNAPSAVE_URL, timeout=90000)
+        print("[WEB] Connected to SnapSave")
+
+        # Fill the Facebook video URL
+        input_selector = "#url"
+        await page.wait_for_selector(input_selector, timeout=60000)
+        await page.fill(input_selector, url)
+        print("[SUBMIT] URL submitted")
+        
+        # Press 'Enter' key to submit the form
+        await page.keyboard.press('Enter')
+        
+        # Instead of a fixed sleep, wait for the download section to be fully visible and stable.
+        # This makes the script more resilient to varying page load times.
+        await page.wait_for_selector("#download-section", timeout=90000, state='visible')
+        print("[WAIT] Processing video...")
+
+        # Wait for the rows of the download table; the first row's button is only a last resort
+        download_button_selector_after_enter = "#download-section > section > div > div.download-link > div:nth-child(2) > div > table > tbody > tr:nth-child(1) > td:nth-child(3) > a"
+        await page.wait_for_selector("#download-section table tbody tr", timeout=30000, state='attached')
+        
+        print("[LINK] Extracting download link...")
+        
+        # Extract the download URL directly from the button or by expecting a download event
+        let_download_url = None
+        selected_quality = None
+        options = []
+        try:
+            options = await page.evaluate(DOWNLOAD_TABLE_ROWS_JS)
+            # Size probes are blocking HTTP requests, so they run off the event loop
+            selected = await asyncio.get_running_loop().run_in_executor(None, choose_download_option, options, prefer)
+            if selected:
+                let_download_url = selected['url']
+                selected_quality = selected['quality']
+        except Exception as e:
+            pass  # Silent fail, will fall back to the first row's button
+        
+        if not let_download_url:
             try:
                 # Attempt to get the href of the download button directly
                 let_download_url = await page.evaluate(f"document.querySelector('{download_button_selector_after_enter}').href")
             except Exception as e:
                 pass  # Silent fail, will try alternative method
+        
+        # If direct URL from button fails, or if it's a blob/redirect, try to expect download
+        if not let_download_url or not (let_download_url.startswith('http') or let_download_url.startswith('https')):
+            async with page.expect_download() as download_info:
+                # Click the download button again to trigger the download event
+                await page.click(download_button_selector_after_enter, timeout=5000) 
             
-            # If direct URL from button fails, or if it's a blob/redirect, try to expect download
-            if not let_download_url or not (let_download_url.startswith('http') or let_download_url.startswith('https')):
-                async with page.expect_download() as download_info:
-                    # Click the download button again to trigger the download event
-                    await page.click(download_button_selector_after_enter, timeout=5000) 
-                
-                download = await download_info.value
-                let_download_url = download.url
-
-            if not let_download_url:
-                raise Exception("Failed to obtain a valid download URL.")
-
-            print("[SUCCESS] Download link obtained successfully")
-            
-            return {
-                "success": True,
-                "download_url": let_download_url # Returning the extracted download URL
-            }
-            
+            download = await download_info.value
+            let_download_url = download.url
+
+        if not let_download_url:
+            raise Exception("Failed to obtain a valid download URL.")
+
+        print(f"[SUCCESS] Download link obtained successfully ({selected_quality or 'default quality'})")
+        
+        return {
+            "success": True,
+            "download_url": let_download_url, # Returning the extracted download URL
+            "quality": selected_quality,
+            "options": options,
+            "blocking": blocker.finish(),
+            "method": "browser"
+        }
+    finally:
+        try:
+            await page.close()
+        except Exception as cleanup_error:
+            print(f"[CLEANUP] Warning: Error during cleanup: {cleanup_error}")
+
+# SnapSave endpoints and the browserless fast path (override through environment variables)
+SNAPSAVE_URL = os.getenv('AUDIO_SNAPSAVE_URL', 'https://snapsave.app/')
+SNAPSAVE_ACTION_URL = os.getenv('AUDIO_SNAPSAVE_ACTION_URL', 'https://snapsave.app/action.php?lang=en')
+HTTP_FAST_PATH = os.getenv('AUDIO_SNAPSAVE_HTTP', '1') != '0'
+HTTP_TIMEOUT = int(os.getenv('AUDIO_SNAPSAVE_HTTP_TIMEOUT', '20'))
+# Lookups of one batch that run at the same time, each in its own tab
+BATCH_RESOLVE_PARALLELISM = int(os.getenv('AUDIO_BATCH_RESOLVE_PARALLELISM', '4'))
+
+# Alphabet of the number bases used by SnapSave's packed response script
+PACKED_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ+/"
+PACKED_CALL = re.compile(r'\}\("(.*?)",\s*(\d+),\s*"(.*?)",\s*(\d+),\s*(\d+),\s*(\d+)\)\)', re.S)
+INNER_HTML = re.compile(r'\.innerHTML\s*=\s*"((?:[^"\\]|\\.)*)"', re.S)
+
+_http_session = requests.Session()
+
+def _from_base(token, base):
+    digits = PACKED_DIGITS[:base]
+    value = 0
+    for power, char in enumerate(reversed(token)):
+        index = digits.find(char)
+        if index != -1:
+            value += index * base ** power
+    return value
+
+def decode_packed_script(script):
+    """
+    Unpack the eval(function(h,u,n,t,e,r){...}(...)) script that action.php returns.
+    Every character is a run of symbols from `n`, read as a number in base `e`,
+    minus the offset `t`; runs are separated by n[e].
+    """
+    match = PACKED_CALL.search(script)
+    if not match:
+        return script
+    packed, _, symbols, offset, base = match.group(1), match.group(2), match.group(3), int(match.group(4)), int(match.group(5))
+    characters = []
+    for run in packed.split(symbols[base]):
+        if not run:
+            continue
+        for index, symbol in enumerate(symbols):
+            run = run.replace(symbol, str(index))
+        characters.append(chr(_from_base(run, base) - offset))
+    decoded = ''.join(characters)
+    try:
+        # The script ends with decodeURIComponent(escape(r)): the characters are UTF-8 bytes
+        return decoded.encode('latin-1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return decoded
+
+def _js_string(value):
+    try:
+        return json.loads('"' + value.replace("\\'", "'") + '"')
+    except ValueError:
+        return value.replace('\\"', '"').replace('\\/', '/')
+
+def parse_download_table(html):
+    """Rows of SnapSave's download table as [{'quality', 'url'}], like DOWNLOAD_TABLE_ROWS_JS"""
+    soup = BeautifulSoup(html, 'html.parser')
+    options = []
+    for row in soup.select('table tbody tr'):
+        cells = row.find_all('td')
+        link = row.find('a', href=True)
+        options.append({
+            'quality': cells[0].get_text(strip=True) if cells else '',
+            'url': link['href'] if link else None
+        })
+    if not options:
+        # Single-rendition results have download buttons but no table
+        options = [{'quality': '', 'url': link['href']} for link in soup.find_all('a', href=True) if link['href'].startswith('http')]
+    return options
+
+def resolve_via_http(url, prefer='video'):
+    """
+    Submit the SnapSave form with a plain POST and read the download table from the
+    response, without a browser. Returns the same dict as the browser flow and raises
+    when the response has no usable link.
+    """
+    start = time.perf_counter()
+    response = _http_session.post(
+        SNAPSAVE_ACTION_URL,
+        data={'url': url},
+        headers={
+            'User-Agent': CONTEXT_OPTIONS['user_agent'],
+            'Origin': SNAPSAVE_URL.rstrip('/'),
+            'Referer': SNAPSAVE_URL,
+        },
+        timeout=HTTP_TIMEOUT
+    )
+    if response.status_code != 200:
+        raise Exception(f"SnapSave answered HTTP {response.status_code}")
+
+    script = response.text
+    # Some responses are packed more than once
+    for _ in range(3):
+        if not PACKED_CALL.search(script):
+            break
+        script = decode_packed_script(script)
+    fragments = [_js_string(value) for value in INNER_HTML.findall(script)]
+    html = '\n'.join(fragments) if fragments else script
+    options = parse_download_table(html)
+    selected = choose_download_option(options, prefer)
+    if not selected:
+        message = BeautifulSoup(html, 'html.parser').get_text(' ', strip=True)[:200]
+        raise Exception(f"No download link in SnapSave response{': ' + message if message else ''}")
+
+    print(f"[SUCCESS] Download link obtained over HTTP in {time.perf_counter() - start:.2f}s ({selected['quality'] or 'default quality'})")
+    return {
+        "success": True,
+        "download_url": selected['url'],
+        "quality": selected['quality'],
+        "options": options,
+        "method": "http"
+    }
+
+async def download_facebook_video_snapsave(url, prefer='video', pool=None, fast_path=HTTP_FAST_PATH):
+    """
+    Download a Facebook video using snapsave.app
+    prefer='audio' picks the smallest rendition that is still enough for audio extraction.
+    The browserless HTTP resolver is tried first (unless `fast_path` is off); the browser
+    flow below only runs when it fails.
+    With `pool` (a browser_pool.BrowserPool, called on its loop) a fresh context on a warm
+    browser is used; without one a browser is launched for this lookup and closed afterwards.
+    """
+    print(f"[PHONE] Processing with SnapSave: {url[:50]}...")
+
+    if fast_path:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, resolve_via_http, url, prefer)
         except Exception as e:
-            print(f"[ERROR] SnapSave error: {str(e)}")
-            return {"success": False, "error": str(e)}
+            print(f"[FALLBACK] HTTP lookup failed, using the browser: {str(e)[:150]}")
+            metrics.FALLBACKS.inc(source='snapsave_http', target='browser')
+
+    try:
+        if pool:
+            async with pool.context(**CONTEXT_OPTIONS) as context:
+                return await resolve_in_context(context, url, prefer)
+
+        from playwright.async_api import async_playwright
+        async with async_playwright() as p:
+            # Launch browser using system Chrome instead of Playwright's Chromium
+            browser = await p.chromium.launch(
+                headless=True,
+                executable_path='/usr/bin/google-chrome'
+            )
+            try:
+                context = await browser.new_context(**CONTEXT_OPTIONS)
+                return await resolve_in_context(context, url, prefer)
+            finally:
+                try:
+                    await browser.close()
+                except Exception as cleanup_error:
+                    print(f"[CLEANUP] Warning: Error during cleanup: {cleanup_error}")
         
+    except OverloadedError:
+        raise  # The browser pool is full: callers answer 429 instead of a failed lookup
+    except Exception as e:
+        print(f"[ERROR] SnapSave error: {str(e)}")
+        return {"success": False, "error": str(e)}
+
+class SharedBrowser:
+    """
+    One browser launched on first use and shared by the lookups of a batch, each in
+    its own context. Offers the same context() as browser_pool.BrowserPool.
+    """
+
+    def __init__(self, executable_path='/usr/bin/google-chrome'):
+        self.executable_path = executable_path
+        self.playwright = None
+        self.browser = None
+        self.lock = asyncio.Lock()
+
+    async def _get_browser(self):
+        async with self.lock:
+            if self.browser is None:
+                from playwright.async_api import async_playwright
+                self.playwright = await async_playwright().start()
+                options = {'headless': True}
+                if os.path.exists(self.executable_path):
+                    options['executable_path'] = self.executable_path
+                self.browser = await self.playwright.chromium.launch(**options)
+            return self.browser
+
+    @asynccontextmanager
+    async def context(self, **context_options):
+        browser = await self._get_browser()
+        context = await browser.new_context(**context_options)
+        try:
+            yield context
         finally:
             try:
-                if page:
-                    await page.close()
-                if context:
-                    await context.close()
-                if browser:
-                    await browser.close()
-            except Exception as cleanup_error:
-                print(f"[CLEANUP] Warning: Error during cleanup: {cleanup_error}")
+                await context.close()
+            except Exception:
+                pass
+
+    async def close(self):
+        try:
+            if self.browser:
+                await self.browser.close()
+            if self.playwright:
+                await self.playwright.stop()
+        except Exception as cleanup_error:
+            print(f"[CLEANUP] Warning: Error during cleanup: {cleanup_error}")
+
+class _BatchPool:
+    """
+    A browser pool as seen by one batch: at most `limit` of its contexts at a time.
+    Lookups over the limit queue here instead of in the pool, where they would count
+    against interactive jobs' bounded waits.
+    """
+
+    def __init__(self, pool, limit):
+        self.pool = pool
+        self.semaphore = asyncio.Semaphore(max(1, limit))
+
+    @asynccontextmanager
+    async def context(self, **context_options):
+        async with self.semaphore:
+            async with self.pool.context(**context_options) as context:
+                yield context
+
+async def resolve_batch(urls, prefer='video', pool=None, parallelism=BATCH_RESOLVE_PARALLELISM):
+    """
+    Resolve many URLs at once, at most `parallelism` at a time, and yield
+    (index, url, result) in completion order. Each result is the dict returned by
+    download_facebook_video_snapsave, so one failing URL never fails the others.
+    Browser lookups share `pool` (never more of its contexts than it has), or a
+    single browser launched for the batch.
+    """
+    semaphore = asyncio.Semaphore(max(1, parallelism))
+    if pool is not None:
+        shared = _BatchPool(pool, min(parallelism, getattr(pool, 'capacity', parallelism)))
+    else:
+        shared = SharedBrowser()
+
+    async def resolve_one(index, url):
+        async with semaphore:
+            try:
+                result = await download_facebook_video_snapsave(url, prefer, pool=shared)
+            except Exception as e:
+                result = {"success": False, "error": str(e)}
+            return index, url, result
+
+    tasks = [asyncio.ensure_future(resolve_one(index, url)) for index, url in enumerate(urls)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        if pool is None:
+            await shared.close()
 
 async def main():
     parser = argparse.ArgumentParser(description='Extract download link from snapsave.app')
-    parser.add_argument('url', help='URL of the Facebook video')
+    parser.add_argument('url', nargs='+', help='URL of the Facebook video (several URLs are resolved concurrently)')
+    parser.add_argument('--parallel', type=int, default=BATCH_RESOLVE_PARALLELISM, help='Lookups at a time for several URLs')
+    parser.add_argument('--prefer', choices=['video', 'audio'], default='video', help='Best rendition, or the smallest one with audio')
     args = parser.parse_args()
 
-    result = await download_facebook_video_snapsave(args.url)
+    if len(args.url) > 1:
+        await main_batch(args.url, args.parallel, args.prefer)
+        return
+
+    # Repeat lookups of the same video reuse a still valid URL resolved by any process
+    cached_url = url_cache.get(args.url[0], args.prefer)
+    if cached_url:
+        print(f"DOWNLOAD_LINK:{cached_url}")
+        return
 
+    result = await download_facebook_video_snapsave(args.url[0], args.prefer)
     if result["success"]:
+        url_cache.put(args.url[0], args.prefer, result['download_url'])
+        if result.get("options"):
+            # Every rendition with its size, for callers that want to choose themselves
+            print(f"OPTIONS:{json.dumps(result['options'])}")
         print(f"DOWNLOAD_LINK:{result['download_url']}") # Print the URL in a parsable format
     else:
         print(f"Error:{result['error']}")
 
+async def main_batch(urls, parallel, prefer='video'):
+    """Print one BATCH_RESULT:<json> line per URL as soon as it is resolved"""
+    def emit(index, url, result):
+        line = {"index": index, "url": url, "success": result["success"]}
+        if result["success"]:
+            line["download_url"] = result["download_url"]
+            if result.get("options"):
+                line["options"] = result["options"]
+        else:
+            line["error"] = result["error"]
+        print("BATCH_RESULT:" + json.dumps(line), flush=True)
+
+    misses = []
+    for index, url in enumerate(urls):
+        cached_url = url_cache.get(url, prefer)
+        if cached_url:
+            emit(index, url, {"success": True, "download_url": cached_url})
+        else:
+            misses.append((index, url))
+
+    async for position, url, result in resolve_batch([url for _, url in misses], prefer, parallelism=parallel):
+        if result["success"]:
+            url_cache.put(url, prefer, result['download_url'])
+        emit(misses[position][0], url, result)
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,149 @@
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import fcntl
+except ImportError:  # Windows: writes are still atomic, just not serialized across processes
+    fcntl = None
+
+import metrics
+from audio_cache import canonical_video_id
+
+# Resolved URL cache configuration (override through environment variables)
+URL_CACHE_FILE = os.getenv('AUDIO_URL_CACHE_FILE', os.path.join(tempfile.gettempdir(), 'freefbzone_urls.json'))
+# Entries expire this many seconds before the CDN signature does
+URL_CACHE_MARGIN = int(os.getenv('AUDIO_URL_CACHE_MARGIN', '600'))
+# Lifetime of URLs that carry no expiry we can read; 0 disables caching them
+URL_CACHE_DEFAULT_TTL = int(os.getenv('AUDIO_URL_CACHE_DEFAULT_TTL', '0'))
+URL_CACHE_MAX_ENTRIES = int(os.getenv('AUDIO_URL_CACHE_MAX_ENTRIES', '5000'))
+
+_lock = threading.Lock()
+
+
+def _jwt_payload(token):
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (IndexError, ValueError):
+        return None
+
+
+def url_expiry(url):
+    """
+    Unix time the signed URL stops working, or None if it can't be told.
+    fbcdn URLs carry it as hex in `oe`; SnapSave's proxy links wrap the fbcdn URL
+    (or an `exp` claim) in a JWT `token` parameter.
+    """
+    query = parse_qs(urlparse(url or '').query)
+    expiry = query.get('oe', [None])[0]
+    if expiry:
+        try:
+            return int(expiry, 16)
+        except ValueError:
+            pass
+    token = query.get('token', [None])[0]
+    payload = _jwt_payload(token) if token else None
+    if isinstance(payload, dict):
+        if isinstance(payload.get('exp'), (int, float)):
+            return int(payload['exp'])
+        if isinstance(payload.get('url'), str):
+            return url_expiry(payload['url'])
+    return None
+
+
+class _FileLock:
+    """Exclusive lock on a side file, so processes sharing the cache don't lose each other's writes"""
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self.lock_file = None
+
+    def __enter__(self):
+        _lock.acquire()
+        if fcntl:
+            self.lock_file = open(self.path, 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.lock_file:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+        _lock.release()
+
+
+def _read(path):
+    try:
+        with open(path) as cache_file:
+            entries = json.load(cache_file)
+        return entries if isinstance(entries, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write(path, entries):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-urls-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[URLCACHE] Warning: could not save resolved URLs: {str(e)[:100]}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _key(video_url, prefer):
+    return f"{canonical_video_id(video_url)}|{prefer}"
+
+
+def get(video_url, prefer='video', path=URL_CACHE_FILE):
+    """Cached download URL for the video and rendition preference, or None if missing or about to expire"""
+    entry = _read(path).get(_key(video_url, prefer))
+    if entry and entry.get('expires_at', 0) > time.time():
+        metrics.URL_CACHE_REQUESTS.inc(result='hit')
+        print(f"[URLCACHE] Reusing resolved URL ({int(entry['expires_at'] - time.time()) // 60} min left)")
+        return entry['url']
+    metrics.URL_CACHE_REQUESTS.inc(result='miss')
+    return None
+
+
+def put(video_url, prefer, download_url, path=URL_CACHE_FILE):
+    """Remember a resolved URL until shortly before its signature expires"""
+    expiry = url_expiry(download_url)
+    if expiry is not None:
+        expires_at = expiry - URL_CACHE_MARGIN
+    elif URL_CACHE_DEFAULT_TTL > 0:
+        expires_at = time.time() + URL_CACHE_DEFAULT_TTL
+    else:
+        return
+    now = time.time()
+    if expires_at <= now:
+        return
+    with _FileLock(path):
+        entries = {key: entry for key, entry in _read(path).items() if entry.get('expires_at', 0) > now}
+        entries[_key(video_url, prefer)] = {'url': download_url, 'expires_at': expires_at}
+        if len(entries) > URL_CACHE_MAX_ENTRIES:
+            # Keep the entries that stay valid longest
+            kept = sorted(entries.items(), key=lambda item: item[1]['expires_at'])[-URL_CACHE_MAX_ENTRIES:]
+            entries = dict(kept)
+        _write(path, entries)
+
+
+def invalidate(video_url, path=URL_CACHE_FILE):
+    """Forget every cached URL for the video, e.g. after the CDN rejected one"""
+    prefix = canonical_video_id(video_url) + '|'
+    with _FileLock(path):
+        entries = _read(path)
+        remaining = {key: entry for key, entry in entries.items() if not key.startswith(prefix)}
+        if len(remaining) != len(entries):
+            _write(path, remaining)